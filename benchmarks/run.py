@@ -0,0 +1,205 @@
+"""
+Offline benchmark of full bot cycles against synthetic data.
+
+Each member count runs in its own process, so peak memory is measured per size:
+
+    python -m benchmarks.run --sizes 1000 10000 100000 --api-latency 0.01
+
+MongoDB is mongomock unless --mongo-uri points at a local mongod. Player sessions live in
+SQLite unless --mysql is given, in which case the SQL_* settings must point at a scratch
+MySQL database; its ActivityTracker_PlayerSessions table is dropped and recreated.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+ROLE_ID = 'whitelist'
+SEED_ROLE_ID = 'seed'
+ACTIVITY_ROLE_ID = 'activity'
+
+def configure_environment(args, workdir, api_url):
+    # Set before config is imported; role IDs are forced so a local .env can't leak in
+    os.environ.update({
+        'TIMERS_DB_PATH': os.path.join(workdir, 'timers.db'),
+        'LOG_FILE': os.path.join(workdir, 'bench.log'),
+        'API_URL': api_url,
+        'API_RATE_LIMIT': str(args.api_rate),
+        'API_MAX_IN_FLIGHT': str(args.api_in_flight),
+        'OUTBOX_BATCH_SIZE': '500',
+        'GUILD_ID': 'bench-guild',
+        'ROLE_ID': ROLE_ID,
+        'SEED_ROLE_ID': SEED_ROLE_ID,
+        'ACTIVITY_ROLE_ID': ACTIVITY_ROLE_ID,
+        'USE_DB_CLONE': 'False',
+        'DRY_RUN': str(args.dry_run),
+    })
+    for key, value in {'SQL_PORT': '3306', 'HOURS_THRESHOLD': '25', 'HOURS_PLAYED_WEEKS': '2'}.items():
+        os.environ.setdefault(key, value)
+
+def load_mongo(args, players, configs):
+    import config
+    import database.mongodb as mongodb
+
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        config.MONGODB_URI = args.mongo_uri
+        config.DATABASE_NAME = 'whitelister_bench'
+        client = MongoClient(args.mongo_uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+        # Every connection the bot opens gets the same in-memory server
+        mongodb.MongoClient = lambda *_, **__: client
+
+    database = client[config.DATABASE_NAME]
+    for name, documents in ((config.COLLECTION_NAME, players), ('configs', configs)):
+        database[name].drop()
+        database[name].insert_many(documents)
+
+def load_sessions(args, sessions, main):
+    if args.mysql:
+        from database.sql import sql_connection
+        from benchmarks.sqlite_sessions import to_sqlite
+        with sql_connection() as cnx:
+            cursor = cnx.cursor()
+            cursor.execute('DROP TABLE IF EXISTS ActivityTracker_PlayerSessions')
+            cursor.execute(
+                'CREATE TABLE ActivityTracker_PlayerSessions (steamID VARCHAR(32), joinTime DATETIME, leaveTime DATETIME, '
+                'INDEX idx_steam_join_leave (steamID, joinTime, leaveTime))'
+            )
+            cursor.executemany(
+                'INSERT INTO ActivityTracker_PlayerSessions (steamID, joinTime, leaveTime) VALUES (%s, %s, %s)',
+                [tuple(to_sqlite(value) for value in session) for session in sessions]
+            )
+            cnx.commit()
+            cursor.close()
+        return
+
+    from benchmarks.sqlite_sessions import SQLiteSessions
+    sessions_db = SQLiteSessions()
+    sessions_db.load(sessions)
+
+    @contextmanager
+    def sqlite_connection():
+        yield sessions_db
+
+    main.sql_connection = sqlite_connection
+
+def phase_totals(metrics):
+    with metrics.lock:
+        return {
+            dict(labels)['phase']: value
+            for (name, labels), value in metrics.values.items()
+            if name == 'whitelister_phase_seconds_sum'
+        }
+
+def run_child(args):
+    from benchmarks.stub_api import StubRoleAPI
+    from benchmarks.synthetic import generate_configs, generate_players, generate_sessions
+
+    stub = StubRoleAPI(latency=args.api_latency).start()
+    workdir = tempfile.mkdtemp(prefix='whitelister-bench-')
+    configure_environment(args, workdir, stub.url)
+
+    import config
+    players = generate_players(args.size, ROLE_ID, SEED_ROLE_ID, ACTIVITY_ROLE_ID)
+    sessions = generate_sessions(args.size, config.HOURS_PLAYED_WEEKS)
+    load_mongo(args, players, generate_configs())
+    del players
+
+    import main
+    from utils.metrics import metrics
+    main.initialize()
+    load_sessions(args, sessions, main)
+    del sessions
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cycles = []
+    for _ in range(args.cycles):
+        calls_before = sum(stub.calls.values())
+        phases_before = phase_totals(metrics)
+        started = time.perf_counter()
+        changes = main.main()
+        elapsed = time.perf_counter() - started
+        phases = {
+            phase: round(total - phases_before.get(phase, 0), 4)
+            for phase, total in phase_totals(metrics).items()
+            if phase != 'api_call' and total - phases_before.get(phase, 0) > 0
+        }
+        cycles.append({
+            'seconds': round(elapsed, 3),
+            'changes': changes,
+            'api_calls': sum(stub.calls.values()) - calls_before,
+            'phases': phases,
+        })
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    main.shutdown()
+    stub.stop()
+    print(json.dumps({
+        'members': args.size,
+        'cycles': cycles,
+        'peak_rss_mb': round(rss_after / 1024, 1),
+        'cycle_rss_growth_mb': round((rss_after - rss_before) / 1024, 1),
+    }))
+
+def run_parent(args):
+    forwarded = [
+        '--cycles', str(args.cycles),
+        '--api-latency', str(args.api_latency),
+        '--api-rate', str(args.api_rate),
+        '--api-in-flight', str(args.api_in_flight),
+    ]
+    if args.mongo_uri:
+        forwarded += ['--mongo-uri', args.mongo_uri]
+    if args.mysql:
+        forwarded.append('--mysql')
+    if args.dry_run:
+        forwarded.append('--dry-run')
+
+    results = []
+    for size in args.sizes:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.run', '--child', '--size', str(size), *forwarded],
+            check=True, stdout=subprocess.PIPE, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        for number, cycle in enumerate(result['cycles'], 1):
+            print(
+                f"{size:>7} members  cycle {number}: {cycle['seconds']:>8.2f}s  {cycle['api_calls']:>6} API calls  "
+                f"peak RSS {result['peak_rss_mb']:.0f} MB (+{result['cycle_rss_growth_mb']:.0f} MB in cycles)  "
+                f"{cycle['phases']}"
+            )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark bot cycles against synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Member counts to run')
+    parser.add_argument('--cycles', type=int, default=2, help='Cycles per member count')
+    parser.add_argument('--api-latency', type=float, default=0.005, help='Stub role API latency in seconds')
+    parser.add_argument('--api-rate', type=float, default=1000, help='API_RATE_LIMIT for the run')
+    parser.add_argument('--api-in-flight', type=int, default=16, help='API_MAX_IN_FLIGHT for the run')
+    parser.add_argument('--mongo-uri', help='Use a local mongod instead of mongomock')
+    parser.add_argument('--mysql', action='store_true', help='Use the MySQL database from the SQL_* settings')
+    parser.add_argument('--dry-run', action='store_true', help='Plan role changes without calling the API')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.child:
+        run_child(args)
+    else:
+        run_parent(args)
@@ -0,0 +1,104 @@
+import re
+import sqlite3
+from datetime import date, datetime
+
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+DATETIME_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}')
+
+def translate(query):
+    """
+    Rewrites the MySQL dialect used by the bot's session queries into SQLite.
+    """
+    query = query.replace('%s', '?')
+    return re.sub(
+        r'TIMESTAMPDIFF\(SECOND,\s*(\w+),\s*(\w+)\)',
+        r'CAST(ROUND((julianday(\2) - julianday(\1)) * 86400) AS INTEGER)',
+        query
+    )
+
+def to_sqlite(value):
+    return value.isoformat(' ') if isinstance(value, datetime) else value
+
+def from_sqlite(value):
+    if isinstance(value, str):
+        if DATE_PATTERN.match(value):
+            return date.fromisoformat(value)
+        if DATETIME_PATTERN.match(value):
+            return datetime.fromisoformat(value)
+    return value
+
+class SQLiteCursor:
+    def __init__(self, conn, dictionary):
+        self.conn = conn
+        self.dictionary = dictionary
+        self.cursor = None
+        self.rows = None
+
+    def execute(self, query, params=()):
+        match = re.match(r'\s*SHOW INDEX FROM (\w+)', query, re.IGNORECASE)
+        if match:
+            self.rows = self._show_index(match.group(1))
+            return
+        self.rows = None
+        self.cursor = self.conn.execute(translate(query), [to_sqlite(param) for param in params])
+
+    def _show_index(self, table):
+        # Same columns as the MySQL SHOW INDEX rows the bot reads
+        rows = []
+        for _, name, *_ in self.conn.execute(f'PRAGMA index_list({table})'):
+            for seq, _, column in self.conn.execute(f'PRAGMA index_info({name})'):
+                rows.append({'Key_name': name, 'Seq_in_index': seq + 1, 'Column_name': column})
+        return rows
+
+    def _convert(self, row):
+        row = tuple(from_sqlite(value) for value in row)
+        if self.dictionary:
+            return dict(zip([column[0] for column in self.cursor.description], row))
+        return row
+
+    def fetchall(self):
+        if self.rows is not None:
+            return self.rows
+        return [self._convert(row) for row in self.cursor.fetchall()]
+
+    def fetchmany(self, size=1):
+        return [self._convert(row) for row in self.cursor.fetchmany(size)]
+
+    def __iter__(self):
+        if self.rows is not None:
+            return iter(self.rows)
+        return (self._convert(row) for row in self.cursor)
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+
+class SQLiteSessions:
+    """
+    SQLite stand-in for the ActivityTracker MySQL database, accepting the cursor() calls
+    the bot makes on a mysql.connector connection.
+    """
+    def __init__(self, path=':memory:'):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS ActivityTracker_PlayerSessions (steamID TEXT, joinTime TEXT, leaveTime TEXT)'
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_steam_join_leave ON ActivityTracker_PlayerSessions (steamID, joinTime, leaveTime)'
+        )
+
+    def load(self, sessions):
+        self.conn.executemany(
+            'INSERT INTO ActivityTracker_PlayerSessions (steamID, joinTime, leaveTime) VALUES (?, ?, ?)',
+            [tuple(to_sqlite(value) for value in session) for session in sessions]
+        )
+        self.conn.commit()
+
+    def cursor(self, dictionary=False, **kwargs):
+        return SQLiteCursor(self.conn, dictionary)
+
+    def ping(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubRoleAPI:
+    """
+    Local stand-in for the role API. Answers every add-role and remove-role call with 200
+    after latency seconds, and counts the calls per path. Responses queued with throttle()
+    are sent first.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.scripted = deque()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                with stub.lock:
+                    stub.calls[self.path] += 1
+                    status, headers = stub.scripted.popleft() if stub.scripted else (200, {})
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def throttle(self, count=1, retry_after=None):
+        """
+        Answers the next count calls with 429, with a Retry-After header when given.
+        """
+        headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+        with self.lock:
+            self.scripted.extend([(429, headers)] * count)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='stub-api', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,57 @@
+import random
+from datetime import datetime, timedelta
+
+STEAM_ID_BASE = 76561190000000000
+
+def generate_players(count, role_id, seed_role_id, activity_role_id, seed=0):
+    """
+    Generates Whitelister player documents for count whitelisted members.
+    About 90% have a linked Steam ID, and some already hold the seed or activity role.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    players = []
+    for i in range(count):
+        roles = [role_id]
+        if rng.random() < 0.3:
+            roles.append(seed_role_id)
+        if rng.random() < 0.2:
+            roles.append(activity_role_id)
+        player = {
+            'discord_user_id': str(100000000000000000 + i),
+            'discord_roles_ids': roles,
+            'seeding_points': rng.randint(0, 300),
+            'username': f'player{i}',
+            'updatedAt': now - timedelta(seconds=rng.randint(0, 86400)),
+        }
+        if rng.random() < 0.9:
+            player['steamid64'] = str(STEAM_ID_BASE + i)
+        players.append(player)
+    return players
+
+def generate_configs(reward_minutes=120):
+    return [{
+        'category': 'seeding_tracker',
+        'updatedAt': datetime.now(),
+        'config': {'reward_needed_time': {'value': reward_minutes, 'option': 60000}},
+    }]
+
+def generate_sessions(member_count, weeks, outsiders_per_member=2, seed=0):
+    """
+    Generates (steamID, joinTime, leaveTime) session rows spread over the last weeks + 1
+    weeks, for the members and for players that never joined the whitelist. About 1% of
+    sessions are still open.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    span = int(timedelta(weeks=weeks + 1).total_seconds())
+    sessions = []
+    for i in range(member_count * (1 + outsiders_per_member)):
+        steam_id = str(STEAM_ID_BASE + i)
+        for _ in range(rng.randint(0, 25)):
+            join_time = now - timedelta(seconds=rng.randint(0, span))
+            leave_time = join_time + timedelta(seconds=rng.randint(600, 4 * 3600))
+            if leave_time > now or rng.random() < 0.01:
+                leave_time = None
+            sessions.append((steam_id, join_time, leave_time))
+    return sessions
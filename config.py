@@ -12,6 +12,15 @@ MONGODB_PORT = os.getenv('MONGODB_PORT')
 MONGODB_URI = f'mongodb://{MONGODB_USERNAME}:{MONGODB_PASSWORD}@{MONGODB_HOST}:{MONGODB_PORT}'
 DATABASE_NAME = 'admin'
 COLLECTION_NAME = 'players'
+# Documents per cursor batch when streaming members
+MONGODB_BATCH_SIZE = int(os.getenv('MONGODB_BATCH_SIZE', '1000'))
+# Incremental sync: only fetch players changed since the last cycle
+MONGODB_INCREMENTAL_SYNC = os.getenv('MONGODB_INCREMENTAL_SYNC', 'False').lower() == 'true'
+MONGODB_FULL_RESYNC_CYCLES = int(os.getenv('MONGODB_FULL_RESYNC_CYCLES', '20'))
+# Document field holding the last update time, used when change streams are unavailable
+MONGODB_UPDATED_FIELD = os.getenv('MONGODB_UPDATED_FIELD', 'updatedAt')
+# Seconds before the newest update time read again each cycle, so writes committed late are not missed
+MONGODB_UPDATED_OVERLAP = int(os.getenv('MONGODB_UPDATED_OVERLAP', '60'))
 
 # Flag to determine if cloning is needed
 USE_DB_CLONE = os.getenv('USE_DB_CLONE', 'False').lower() == 'true'
@@ -19,6 +28,10 @@ USE_DB_CLONE = os.getenv('USE_DB_CLONE', 'False').lower() == 'true'
 MONGODB_MAIN_DATA_PATH = os.getenv('MONGODB_MAIN_DATA_PATH')
 MONGODB_CLONE_DATA_PATH = os.getenv('MONGODB_CLONE_DATA_PATH')
 MONGODB_CLONE_CONTAINER_NAME = os.getenv('MONGODB_CLONE_CONTAINER_NAME')
+# Maximum age in seconds of the clone before it is refreshed
+CLONE_MAX_STALENESS = int(os.getenv('CLONE_MAX_STALENESS', '900'))
+# Seconds to wait for the restarted clone to answer a ping
+CLONE_READY_TIMEOUT = int(os.getenv('CLONE_READY_TIMEOUT', '60'))
 
 # SQL Database 
 SQL_HOST = os.getenv('SQL_HOST')
@@ -26,9 +39,19 @@ SQL_PORT = int(os.getenv('SQL_PORT'))
 SQL_USERNAME = os.getenv('SQL_USERNAME')
 SQL_PASSWORD = os.getenv('SQL_PASSWORD')
 SQL_DATABASE = os.getenv('SQL_DATABASE')
+SQL_POOL_SIZE = int(os.getenv('SQL_POOL_SIZE', '3'))
+# Reconnect attempts when a pooled connection fails its health check
+SQL_RECONNECT_ATTEMPTS = int(os.getenv('SQL_RECONNECT_ATTEMPTS', '3'))
+# Steam IDs per IN-list in the hours query
+SQL_IN_CHUNK_SIZE = int(os.getenv('SQL_IN_CHUNK_SIZE', '1000'))
 
 # API 
 API_URL = os.getenv('API_URL')
+# 'session' for the concurrent keep-alive client, 'custom' for the original serial client
+API_CLIENT = os.getenv('API_CLIENT', 'session').lower()
+API_RATE_LIMIT = float(os.getenv('API_RATE_LIMIT', '4'))  # Requests per second
+API_MAX_IN_FLIGHT = int(os.getenv('API_MAX_IN_FLIGHT', '4'))
+API_TIMEOUT = float(os.getenv('API_TIMEOUT', '10'))  # Seconds per request
 
 # Discord 
 GUILD_ID = os.getenv('GUILD_ID')
@@ -41,13 +64,61 @@ HOURS_THRESHOLD = float(os.getenv('HOURS_THRESHOLD'))
 
 # Time window for calculating hours played
 HOURS_PLAYED_WEEKS = int(os.getenv('HOURS_PLAYED_WEEKS'))
+# Seconds before the hours watermark that every refresh reads again, for sessions committed late
+HOURS_WATERMARK_OVERLAP = int(os.getenv('HOURS_WATERMARK_OVERLAP', '600'))
+
+# Role rules as a JSON list; defaults to the seed and activity rules above
+ROLE_RULES = os.getenv('ROLE_RULES', '')
 
 # Timer 
+TIMERS_DB_PATH = os.getenv('TIMERS_DB_PATH', 'timers.db')
 TIMER_DURATION = int(os.getenv('TIMER_DURATION', 1209600))  # Default to 2 weeks
 
+# Outbox of role operations waiting for API confirmation
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '5'))  # Seconds before the first retry
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '3600'))
+OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', '604800'))  # Keep finished operations for 1 week
+# Priority lanes as lane:value lists; operations taken from each lane per round, and pending operations per lane
+OUTBOX_LANE_WEIGHTS = {
+    lane: int(value) for lane, value in
+    (item.split(':') for item in os.getenv('OUTBOX_LANE_WEIGHTS', 'grant:4,expire:2,correct:1').split(','))
+}
+OUTBOX_LANE_DEPTH = {
+    lane: int(value) for lane, value in
+    (item.split(':') for item in os.getenv('OUTBOX_LANE_DEPTH', 'grant:10000,expire:10000,correct:10000').split(','))
+}
+
+# Seconds of confirmed role changes the propagation latency percentiles cover
+LATENCY_WINDOW = int(os.getenv('LATENCY_WINDOW', '86400'))
+
+# Seconds an issued role operation is held back from being sent again while MongoDB catches up (0 disables)
+PENDING_OP_TTL = int(os.getenv('PENDING_OP_TTL', '1800'))
+
+# Sharded mode: SHARD_COUNT workers split the members by a hash of their Discord ID and lease
+# shards from a SQLite file every worker can reach; 1 runs a single unsharded worker
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+SHARD_LEASE_PATH = os.getenv('SHARD_LEASE_PATH', 'shards.db')
+SHARD_LEASE_TTL = float(os.getenv('SHARD_LEASE_TTL', '60'))  # Seconds a lease outlives its last renewal
+
+# Plan role changes and log them without calling the API or writing timers
+DRY_RUN = os.getenv('DRY_RUN', 'False').lower() == 'true'
+
 SLEEP_DURATION = int(os.getenv('SLEEP_DURATION', 60)) # Default to 1 minute
+# Bounds of the adaptive polling interval
+SLEEP_MIN_DURATION = int(os.getenv('SLEEP_MIN_DURATION', max(10, SLEEP_DURATION // 3)))
+SLEEP_MAX_DURATION = int(os.getenv('SLEEP_MAX_DURATION', SLEEP_DURATION * 5))
+
+# Metrics in Prometheus text format: HTTP port (0 disables) and/or node exporter textfile path
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE', '')
 
 # Logging 
+# DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 LOG_FILE = os.getenv('LOG_FILE', 'app.log')
-LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', '1000000'))
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', '10000000'))
 LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+# Number of user IDs to include with each per-cycle count at INFO; full lists are logged at DEBUG
+LOG_ID_SAMPLE = int(os.getenv('LOG_ID_SAMPLE', '0'))
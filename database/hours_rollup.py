@@ -0,0 +1,258 @@
+import logging
+from datetime import datetime, timedelta
+import config
+from database.sql import SESSIONS_TABLE, check_sessions_index
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hours_rollup (
+    steam_id TEXT,
+    day TEXT,
+    seconds INTEGER,
+    PRIMARY KEY (steam_id, day)
+);
+CREATE TABLE IF NOT EXISTS hours_tracked (
+    steam_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS hours_sessions (
+    steam_id TEXT,
+    join_time TEXT,
+    leave_time TEXT,
+    PRIMARY KEY (steam_id, join_time)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# Closed sessions of the given players that ended at or before a cutoff, summed per player
+# and day of joinTime. Used to backfill players who became members.
+SESSIONS_QUERY = """
+SELECT
+    steamID,
+    DATE(joinTime) AS day,
+    SUM(TIMESTAMPDIFF(SECOND, joinTime, leaveTime)) AS seconds
+FROM
+    {table}
+WHERE
+    steamID IN ({steam_ids}) AND joinTime >= %s AND leaveTime <= %s
+GROUP BY
+    steamID, day
+"""
+
+# Closed sessions of the given players that ended after a cutoff, one row per session so
+# sessions already counted can be told apart. Sessions still open have no leaveTime and
+# are picked up once they close.
+RECENT_SESSIONS_QUERY = """
+SELECT
+    steamID,
+    joinTime,
+    leaveTime,
+    TIMESTAMPDIFF(SECOND, joinTime, leaveTime) AS seconds
+FROM
+    {table}
+WHERE
+    steamID IN ({steam_ids}) AND joinTime >= %s AND leaveTime > %s
+"""
+
+# Latest leaveTime among the given players' sessions, which starts the watermark on the
+# sessions table's own clock
+LAST_LEAVE_QUERY = """
+SELECT MAX(leaveTime) FROM {table} WHERE steamID IN ({steam_ids})
+"""
+
+UPSERT_DAY = '''
+INSERT INTO hours_rollup (steam_id, day, seconds) VALUES (?, ?, ?)
+ON CONFLICT (steam_id, day) DO UPDATE SET seconds = seconds + excluded.seconds
+'''
+
+class HoursRollup:
+    """
+    Seconds played per member Steam ID and day, kept in the local store. Each cycle tops
+    it up with the sessions of tracked players that closed since the last one, and
+    backfills players who became members. Days that leave the HOURS_PLAYED_WEEKS window
+    and players who are no longer members are dropped.
+    The watermark is the latest leaveTime counted. Every refresh reads the sessions that
+    closed up to HOURS_WATERMARK_OVERLAP seconds before it again, so sessions sharing the
+    watermark's leaveTime or committed late aren't missed, and skips the ones already
+    counted, which hours_sessions lists by (steam_id, join_time).
+    """
+    def __init__(self, store):
+        self.store = store
+        self.index_checked = False
+        with self.store.transaction():
+            self.store.execute_script(ROLLUP_SCHEMA)
+            # A different window needs history the rollup doesn't have, so rebuild it.
+            # hours_sessions only covers the overlap it was kept for, and rollups from before
+            # member tracking or session dedup can't be told apart from new sessions, so those
+            # are rebuilt too.
+            if (self._get_state('hours_window_weeks') != str(config.HOURS_PLAYED_WEEKS) or
+                    self._get_state('hours_overlap') != str(config.HOURS_WATERMARK_OVERLAP) or
+                    self._get_state('hours_scope') != 'member_sessions'):
+                logger.info(f'Rebuilding hours rollup for a {config.HOURS_PLAYED_WEEKS} week window.')
+                self.store.execute('DELETE FROM hours_rollup')
+                self.store.execute('DELETE FROM hours_tracked')
+                self.store.execute('DELETE FROM hours_sessions')
+                self.store.execute("DELETE FROM sync_state WHERE key = 'hours_watermark'")
+                self._set_state('hours_window_weeks', str(config.HOURS_PLAYED_WEEKS))
+                self._set_state('hours_overlap', str(config.HOURS_WATERMARK_OVERLAP))
+                self._set_state('hours_scope', 'member_sessions')
+        self.tracked = {steam_id for steam_id, in self.store.query('SELECT steam_id FROM hours_tracked')}
+
+    def _get_state(self, key):
+        rows = self.store.query('SELECT value FROM sync_state WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def _set_state(self, key, value):
+        self.store.execute('REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+    def window_start(self):
+        return datetime.now() - timedelta(weeks=config.HOURS_PLAYED_WEEKS)
+
+    def _cutoff(self, watermark):
+        # Sessions that closed after the cutoff may still be missing or already counted
+        return watermark - timedelta(seconds=config.HOURS_WATERMARK_OVERLAP)
+
+    def _rows(self, cnx, query, steam_ids, *params):
+        """
+        Yields the rows of query for steam_ids, run SQL_IN_CHUNK_SIZE players at a time.
+        """
+        steam_ids = sorted(steam_ids)
+        for offset in range(0, len(steam_ids), config.SQL_IN_CHUNK_SIZE):
+            chunk = steam_ids[offset:offset + config.SQL_IN_CHUNK_SIZE]
+            # Prepared statements run over the binary protocol without client-side buffering,
+            # so rows are consumed as they stream in
+            cursor = cnx.cursor(prepared=True)
+            try:
+                with metrics.timer('sql_query'):
+                    cursor.execute(
+                        query.format(table=SESSIONS_TABLE, steam_ids=', '.join(['%s'] * len(chunk))),
+                        (*chunk, *params)
+                    )
+                    yield from cursor
+            finally:
+                cursor.close()
+
+    def _last_leave(self, cnx, steam_ids):
+        leaves = [leave_time for leave_time, in self._rows(cnx, LAST_LEAVE_QUERY, steam_ids) if leave_time]
+        return max(leaves, default=None)
+
+    def _backfill(self, cnx, steam_ids, until):
+        """
+        Adds the sessions of steam_ids that closed inside the window, up to until, to the
+        rollup. Returns the number of player-days added.
+        """
+        added = 0
+
+        def upserts():
+            nonlocal added
+            for steam_id, day, seconds in self._rows(cnx, SESSIONS_QUERY, steam_ids, self.window_start(), until):
+                added += 1
+                yield steam_id, day.isoformat(), int(seconds or 0)
+
+        self.store.executemany(UPSERT_DAY, upserts())
+        return added
+
+    def _top_up(self, cnx, steam_ids, since):
+        """
+        Adds the sessions of steam_ids that closed after since and aren't counted yet to the
+        rollup. Returns the number of sessions added and the latest leaveTime among them.
+        """
+        counted = {tuple(row) for row in self.store.query('SELECT steam_id, join_time FROM hours_sessions')}
+        days = {}
+        sessions = []
+        last_leave = None
+        for steam_id, join_time, leave_time, seconds in self._rows(
+                cnx, RECENT_SESSIONS_QUERY, steam_ids, self.window_start(), since):
+            key = (steam_id, join_time.isoformat())
+            if key in counted:
+                continue
+            counted.add(key)
+            sessions.append((*key, leave_time.isoformat()))
+            day = (steam_id, join_time.date().isoformat())
+            days[day] = days.get(day, 0) + int(seconds or 0)
+            last_leave = leave_time if last_leave is None else max(last_leave, leave_time)
+
+        self.store.executemany(UPSERT_DAY, [(*day, seconds) for day, seconds in days.items()])
+        self.store.executemany('INSERT INTO hours_sessions (steam_id, join_time, leave_time) VALUES (?, ?, ?)', sessions)
+        return len(sessions), last_leave
+
+    def refresh(self, cnx):
+        """
+        Pulls the sessions of tracked players closed since the watermark, less the overlap,
+        from MySQL into the rollup.
+        """
+        if not self.index_checked:
+            check_sessions_index(cnx)
+            self.index_checked = True
+
+        window_start = self.window_start()
+
+        with self.store.transaction():
+            # The first backfill sets the watermark, so without one nothing is tracked yet
+            added = 0
+            watermark = self._get_state('hours_watermark')
+            if watermark:
+                watermark = datetime.fromisoformat(watermark)
+                added, last_leave = self._top_up(cnx, self.tracked, self._cutoff(watermark))
+                if last_leave and last_leave > watermark:
+                    watermark = last_leave
+                    self._set_state('hours_watermark', watermark.isoformat())
+                # Sessions that closed before the next cutoff are never read again
+                self.store.execute('DELETE FROM hours_sessions WHERE leave_time <= ?', (self._cutoff(watermark).isoformat(),))
+
+            self.store.execute('DELETE FROM hours_rollup WHERE day < ?', (window_start.date().isoformat(),))
+
+        logger.info(f'Added {added} sessions of {len(self.tracked)} tracked players to the hours rollup.')
+
+    def track(self, cnx, steam_ids):
+        """
+        Makes the rollup cover exactly steam_ids. New players are backfilled up to the
+        cutoff of the watermark and topped up with the sessions after it, which the next
+        refresh then skips, and players who left are dropped.
+        """
+        steam_ids = set(steam_ids)
+        new = steam_ids - self.tracked
+        gone = self.tracked - steam_ids
+        if not new and not gone:
+            return
+
+        with self.store.transaction():
+            if gone:
+                removals = [(steam_id,) for steam_id in gone]
+                self.store.executemany('DELETE FROM hours_rollup WHERE steam_id = ?', removals)
+                self.store.executemany('DELETE FROM hours_sessions WHERE steam_id = ?', removals)
+                self.store.executemany('DELETE FROM hours_tracked WHERE steam_id = ?', removals)
+
+            added = topped_up = 0
+            if new:
+                watermark = self._get_state('hours_watermark')
+                if watermark:
+                    watermark = datetime.fromisoformat(watermark)
+                else:
+                    # Nothing was tracked yet, so the first backfill starts the watermark. It
+                    # is compared with leaveTime values, so it starts at the latest of them
+                    # rather than at our clock, which may differ from the one that wrote them
+                    watermark = self._last_leave(cnx, new) or self.window_start()
+                    self._set_state('hours_watermark', watermark.isoformat())
+                added = self._backfill(cnx, new, self._cutoff(watermark))
+                # The refresh of this cycle already ran, so the overlap is counted now
+                topped_up, _ = self._top_up(cnx, new, self._cutoff(watermark))
+                self.store.executemany('INSERT OR IGNORE INTO hours_tracked (steam_id) VALUES (?)', [(steam_id,) for steam_id in new])
+
+        self.tracked = steam_ids
+        logger.info(f'Hours rollup now tracks {len(new)} new players with {added} player-days and {topped_up} recent sessions, and dropped {len(gone)}.')
+
+    def hours_by_steam_id(self):
+        """
+        Returns hours played inside the window per tracked Steam ID. The window is counted
+        in whole days, starting at the day HOURS_PLAYED_WEEKS weeks ago.
+        """
+        rows = self.store.query(
+            'SELECT steam_id, SUM(seconds) FROM hours_rollup WHERE day >= ? GROUP BY steam_id',
+            (self.window_start().date().isoformat(),)
+        )
+        return {steam_id: seconds / 3600 for steam_id, seconds in rows}
@@ -0,0 +1,144 @@
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import config
+
+logger = logging.getLogger(__name__)
+
+TIMERS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS timers (
+    discord_user_id TEXT,
+    role_id TEXT,
+    expiration_time INTEGER,
+    start_time TEXT,
+    PRIMARY KEY (discord_user_id, role_id)
+);
+CREATE INDEX IF NOT EXISTS idx_timers_expiration ON timers (expiration_time);
+'''
+
+class LocalStore:
+    """
+    Long-lived SQLite connection holding the bot's local state.
+    The database runs in WAL mode unless another journal_mode is given, and every write
+    issued inside transaction() is committed together, so a whole cycle costs a single
+    commit.
+    """
+    def __init__(self, path, journal_mode='WAL'):
+        self.path = path
+        self.lock = threading.RLock()
+        # Transaction nesting depth of the thread holding the lock
+        self._local = threading.local()
+        # isolation_level=None leaves transaction control to us; statements outside
+        # transaction() autocommit individually.
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute(f'PRAGMA journal_mode={journal_mode}')
+        # NORMAL is only safe against power loss in WAL mode
+        self.conn.execute('PRAGMA synchronous=NORMAL' if journal_mode == 'WAL' else 'PRAGMA synchronous=FULL')
+
+    def initialize(self):
+        """
+        Creates the timers table, migrating tables from older versions: ISO-formatted
+        expirations, and one timer per user instead of one per user and role.
+        """
+        with self.transaction():
+            columns = {row[1]: (row[2], row[5]) for row in self.conn.execute('PRAGMA table_info(timers)')}
+            if columns:
+                text_expirations = columns['expiration_time'][0].upper() == 'TEXT'
+                per_user = columns['role_id'][1] == 0
+                if text_expirations or per_user:
+                    self._migrate_timers(text_expirations)
+            self.execute_script(TIMERS_SCHEMA)
+
+    def execute_script(self, script):
+        # executescript() would commit the open transaction, so run statements one by one
+        with self.lock:
+            for statement in script.split(';'):
+                if statement.strip():
+                    self.conn.execute(statement)
+
+    def _migrate_timers(self, text_expirations):
+        logger.info(f'Migrating timers in {self.path} to the current schema.')
+        self.conn.execute('ALTER TABLE timers RENAME TO timers_legacy')
+        self.execute_script(TIMERS_SCHEMA)
+        rows = self.conn.execute(
+            'SELECT discord_user_id, role_id, expiration_time, start_time FROM timers_legacy'
+        ).fetchall()
+        self.conn.executemany(
+            'INSERT INTO timers (discord_user_id, role_id, expiration_time, start_time) VALUES (?, ?, ?, ?)',
+            [
+                (
+                    user_id,
+                    role_id,
+                    int(datetime.fromisoformat(expiration_time).timestamp()) if text_expirations else expiration_time,
+                    start_time
+                )
+                for user_id, role_id, expiration_time, start_time in rows
+            ]
+        )
+        self.conn.execute('DROP TABLE timers_legacy')
+        logger.info(f'Migrated {len(rows)} timers.')
+
+    def execute(self, query, args=()):
+        with self.lock:
+            self.conn.execute(query, args)
+
+    def executemany(self, query, rows):
+        with self.lock:
+            self.conn.executemany(query, rows)
+
+    def query(self, query, args=()):
+        with self.lock:
+            return self.conn.execute(query, args).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every write made inside the block into one commit, and rolls them back if
+        the block raises. Nested blocks join the outermost one through a savepoint, so a
+        nested block that raises only undoes its own writes. The store lock is held until
+        the block ends, so writes from other threads wait instead of joining it.
+        """
+        with self.lock:
+            depth = getattr(self._local, 'depth', 0)
+            savepoint = f'nested_{depth}'
+            self.conn.execute('BEGIN IMMEDIATE' if depth == 0 else f'SAVEPOINT {savepoint}')
+            self._local.depth = depth + 1
+            try:
+                yield self
+            except BaseException:
+                # SQLite may already have rolled back on its own, e.g. when the disk is full
+                if not self.conn.in_transaction:
+                    pass
+                elif depth == 0:
+                    self.conn.execute('ROLLBACK')
+                else:
+                    self.conn.execute(f'ROLLBACK TO {savepoint}')
+                    self.conn.execute(f'RELEASE {savepoint}')
+                raise
+            else:
+                self.conn.execute('COMMIT' if depth == 0 else f'RELEASE {savepoint}')
+            finally:
+                self._local.depth = depth
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+            logger.info(f'Connection to {self.path} closed.')
+
+_local_store = None
+
+def get_local_store():
+    """
+    Returns the process-wide LocalStore, opening it on first use.
+    """
+    global _local_store
+    if _local_store is None:
+        if not os.path.exists(config.TIMERS_DB_PATH):
+            logger.info(f'Database {config.TIMERS_DB_PATH} does not exist. Creating a new one.')
+        # Shard stores may live on a network share for failover between hosts, where WAL's
+        # shared memory doesn't work, so they use a rollback journal
+        _local_store = LocalStore(config.TIMERS_DB_PATH, 'DELETE' if config.SHARD_COUNT > 1 else 'WAL')
+    return _local_store
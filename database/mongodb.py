@@ -1,18 +1,161 @@
 from pymongo import MongoClient, errors as mongo_errors
 import logging
+import time
+from datetime import datetime, timedelta
+import numpy as np
 import config
-from utils import run_rsync
+from utils import clone_refresher
+from utils.metrics import metrics
+from collections import namedtuple
 from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
+# The only player fields the bot reads; everything else stays on the server
+MEMBER_FIELDS = ('discord_user_id', 'discord_roles_ids', 'seeding_points', 'steamid64')
+MEMBER_PROJECTION = {'_id': 0, **{field: 1 for field in MEMBER_FIELDS}}
+
+# Compact member record; discord_roles_ids is a frozenset for cheap membership tests
+Member = namedtuple('Member', MEMBER_FIELDS)
+
+def to_member(doc):
+    return Member(
+        doc.get('discord_user_id'),
+        frozenset(doc.get('discord_roles_ids') or ()),
+        doc.get('seeding_points', 0),
+        doc.get('steamid64')
+    )
+
+class MemberColumns:
+    """
+    Columnar snapshot of the members, kept up to date as they are synced: parallel ID
+    lists and NumPy arrays of their seeding points, Steam ID presence and a bitmap of the
+    given role IDs they hold. Each member has a slot; the slot of a member who leaves is
+    reused by the next one, and live marks the slots in use. Rules are evaluated as array
+    operations over it, and only the selected members go back to Python.
+    """
+    def __init__(self, role_ids):
+        self.role_ids = tuple(role_ids)
+        self.role_bits = {}
+        for role_id in self.role_ids:
+            self.role_bits.setdefault(role_id, 1 << len(self.role_bits))
+        self.positions = {}  # discord_user_id -> slot
+        self.free = []
+        self.members = []    # Member per slot, None for free slots
+        self.user_ids = []
+        self.steam_ids = []
+        self.size = 0
+        self._seeding_points = np.zeros(0, dtype=np.float64)
+        self._roles = np.zeros(0, dtype=np.uint64)
+        self._has_steam_id = np.zeros(0, dtype=bool)
+        self._live = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def seeding_points(self):
+        return self._seeding_points[:self.size]
+
+    @property
+    def roles(self):
+        return self._roles[:self.size]
+
+    @property
+    def has_steam_id(self):
+        return self._has_steam_id[:self.size]
+
+    @property
+    def live(self):
+        return self._live[:self.size]
+
+    def _new_slot(self):
+        if self.free:
+            return self.free.pop()
+        if self.size == len(self._live):
+            capacity = max(1024, 2 * self.size)
+            for name in ('_seeding_points', '_roles', '_has_steam_id', '_live'):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+        self.members.append(None)
+        self.user_ids.append(None)
+        self.steam_ids.append(None)
+        self.size += 1
+        return self.size - 1
+
+    def update(self, member):
+        """
+        Stores the member, writing its slot only when its record changed.
+        """
+        position = self.positions.get(member.discord_user_id)
+        if position is None:
+            position = self._new_slot()
+            self.positions[member.discord_user_id] = position
+        elif self.members[position] == member:
+            return
+        self.members[position] = member
+        self.user_ids[position] = member.discord_user_id
+        self.steam_ids[position] = member.steamid64
+        self._seeding_points[position] = member.seeding_points or 0
+        self._roles[position] = sum(bit for role_id, bit in self.role_bits.items() if role_id in member.discord_roles_ids)
+        self._has_steam_id[position] = bool(member.steamid64)
+        self._live[position] = True
+
+    def discard(self, user_id):
+        position = self.positions.pop(user_id, None)
+        if position is None:
+            return
+        self.members[position] = self.user_ids[position] = self.steam_ids[position] = None
+        self._seeding_points[position] = 0
+        self._roles[position] = 0
+        self._has_steam_id[position] = False
+        self._live[position] = False
+        self.free.append(position)
+
+    def retain(self, user_ids):
+        """
+        Discards every member whose ID is not in user_ids.
+        """
+        for user_id in self.positions.keys() - user_ids:
+            self.discard(user_id)
+
+    def get(self, user_id):
+        position = self.positions.get(user_id)
+        return None if position is None else self.members[position]
+
+    def has_role(self, role_id):
+        return (self.roles & np.uint64(self.role_bits[role_id])) != 0
+
+    def hours_played(self, hours_by_steam_id):
+        return np.fromiter(
+            (hours_by_steam_id.get(steam_id, 0) if steam_id else 0 for steam_id in self.steam_ids),
+            np.float64, self.size
+        )
+
+    def timer_expirations(self, timers, role_id):
+        """
+        Returns the expiration of each member's timer for the role, NaN where there is none.
+        """
+        expirations = np.full(self.size, np.nan)
+        for (user_id, timer_role_id), timer in timers.items():
+            position = self.positions.get(user_id)
+            if timer_role_id == role_id and position is not None:
+                expirations[position] = timer.expiration
+        return expirations
+
+    def select(self, mask):
+        return [self.user_ids[position] for position in np.flatnonzero(mask)]
+
 @contextmanager
 def mongo_connection():
     uri = config.MONGODB_URI
     client = None
     try:
-        client = MongoClient(uri, serverSelectionTimeoutMS=5000)
-        client.admin.command('ping')
+        with metrics.timer('mongo_connect'):
+            client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+            client.admin.command('ping')
         logger.info('Connected successfully to MongoDB')
         yield client
     except mongo_errors.ServerSelectionTimeoutError:
@@ -30,11 +173,16 @@ def mongo_connection():
             logger.info('Connection to MongoDB closed.')
 
 def fetch_members_with_role(database):
+    """
+    Returns the members with ROLE_ID, or None when they could not be fetched.
+    """
     try:
 
         collection = database[config.COLLECTION_NAME]
         query = {'discord_roles_ids': config.ROLE_ID}
-        data = list(collection.find(query))
+        # Stream projected documents and keep only compact records in memory
+        cursor = collection.find(query, MEMBER_PROJECTION, batch_size=config.MONGODB_BATCH_SIZE)
+        data = [to_member(doc) for doc in cursor]
 
         if not data:
             logger.info(f'No data found for role: {config.ROLE_ID}')
@@ -44,10 +192,10 @@ def fetch_members_with_role(database):
 
     except mongo_errors.PyMongoError as err:
         logger.error(f'MongoDB error during member fetch: {err}')
-        return []
+        return None
     except Exception as err:
         logger.error(f'An error occurred during member fetch: {err}')
-        return []
+        return None
 
 def fetch_reward_needed_points(database, category='seeding_tracker'):
     try:
@@ -96,18 +244,229 @@ def fetch_reward_needed_points(database, category='seeding_tracker'):
         logger.error(f'An unexpected error occurred during config fetch: {err}')
         return None
 
-def perform_database_operations():
+class IncrementalSync:
+    """
+    Keeps a local snapshot of members with ROLE_ID and refreshes it from the documents that
+    changed since the last cycle. Changes come from a change stream when the deployment
+    supports one (replica sets), and from a query on MONGODB_UPDATED_FIELD otherwise.
+    A full resync runs every MONGODB_FULL_RESYNC_CYCLES cycles, which also drops players
+    deleted while only the timestamp query was available.
+    The members are also kept in MemberColumns, updated only for the documents that
+    changed. An optional member_filter limits the snapshot to the members it accepts.
+    """
+    def __init__(self, full_resync_cycles):
+        self.full_resync_cycles = full_resync_cycles
+        self.updated_field = config.MONGODB_UPDATED_FIELD
+        # Snapshot keyed by document _id, because change stream deletes only carry the _id
+        self.members = {}
+        self.columns = None
+        self.member_filter = None
+        self.cycles_since_resync = None
+        self.use_change_stream = None
+        self.resume_token = None
+        self.watermark = None
+        self.reward_version = None
+        self.reward_points = None
+        # Whether the config document was last seen without MONGODB_UPDATED_FIELD
+        self.reward_unversioned = False
+
+    def sync(self, database, role_ids=(), member_filter=None):
+        """
+        Brings the snapshot up to date and returns (members, changed_count). The columns
+        keep a bitmap of role_ids.
+        """
+        collection = database[config.COLLECTION_NAME]
+        self.member_filter = member_filter
+        if self.columns is None or self.columns.role_ids != tuple(role_ids):
+            self.columns = MemberColumns(role_ids)
+            self.cycles_since_resync = None
+        if self.cycles_since_resync is None or self.cycles_since_resync >= self.full_resync_cycles:
+            changed = self.full_resync(collection)
+        else:
+            try:
+                changed = self.apply_changes(collection)
+                self.cycles_since_resync += 1
+            except mongo_errors.PyMongoError as err:
+                logger.warning(f'Incremental member sync failed, falling back to a full resync: {err}')
+                changed = self.full_resync(collection)
+        return list(self.members.values()), changed
+
+    def full_resync(self, collection):
+        if self.use_change_stream is None:
+            self.use_change_stream = self._supports_change_stream(collection)
+
+        if self.use_change_stream:
+            # Take the resume token before scanning so changes made during the scan are replayed
+            with collection.watch(full_document='updateLookup') as stream:
+                self.resume_token = stream.resume_token
+        else:
+            latest = collection.find_one(
+                {self.updated_field: {'$exists': True}},
+                {'_id': 0, self.updated_field: 1},
+                sort=[(self.updated_field, -1)]
+            )
+            self.watermark = latest[self.updated_field] if latest else None
+            if self.watermark is None:
+                logger.warning(f'Players have no {self.updated_field} field; every cycle will be a full resync.')
+
+        query = {'discord_roles_ids': config.ROLE_ID}
+        projection = {**MEMBER_PROJECTION, '_id': 1}
+        cursor = collection.find(query, projection, batch_size=config.MONGODB_BATCH_SIZE)
+        self.members = {}
+        for doc in cursor:
+            self._apply(doc['_id'], doc)
+        self.columns.retain({member.discord_user_id for member in self.members.values()})
+
+        # Without a change stream or watermark there is nothing to sync incrementally from
+        if self.use_change_stream or self.watermark is not None:
+            self.cycles_since_resync = 0
+        logger.info(f'Full member resync loaded {len(self.members)} members.')
+        return len(self.members)
+
+    def apply_changes(self, collection):
+        if self.use_change_stream:
+            return self._apply_change_stream(collection)
+        return self._apply_updated_since(collection)
+
+    def _supports_change_stream(self, collection):
+        try:
+            with collection.watch():
+                pass
+            logger.info('Using a change stream for incremental member sync.')
+            return True
+        except mongo_errors.OperationFailure as err:
+            logger.info(f'Change streams unavailable ({err}), using {self.updated_field} for incremental member sync.')
+            return False
+
+    def _apply_change_stream(self, collection):
+        pipeline = [
+            {'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}},
+            {'$project': {
+                'operationType': 1,
+                'documentKey': 1,
+                **{f'fullDocument.{field}': 1 for field in MEMBER_FIELDS}
+            }}
+        ]
+        changed = 0
+        with collection.watch(pipeline, full_document='updateLookup', resume_after=self.resume_token) as stream:
+            while True:
+                change = stream.try_next()
+                if change is None:
+                    break
+                self._apply(change['documentKey']['_id'], change.get('fullDocument'))
+                changed += 1
+            self.resume_token = stream.resume_token
+        return changed
+
+    def _apply_updated_since(self, collection):
+        # Documents written just before the watermark may commit after it was read, so the
+        # last MONGODB_UPDATED_OVERLAP seconds are read again; applying a document twice is harmless
+        since = self.watermark
+        if isinstance(since, datetime):
+            since -= timedelta(seconds=config.MONGODB_UPDATED_OVERLAP)
+        query = {self.updated_field: {'$gte': since}}
+        projection = {**MEMBER_PROJECTION, '_id': 1, self.updated_field: 1}
+        changed = 0
+        for doc in collection.find(query, projection, batch_size=config.MONGODB_BATCH_SIZE):
+            self._apply(doc['_id'], doc)
+            self.watermark = max(self.watermark, doc[self.updated_field])
+            changed += 1
+        return changed
+
+    def _apply(self, doc_id, doc):
+        # Players that were deleted, lost ROLE_ID or are filtered out leave the snapshot
+        member = to_member(doc) if doc and config.ROLE_ID in (doc.get('discord_roles_ids') or ()) else None
+        if member and self.member_filter and not self.member_filter(member):
+            member = None
+        previous = self.members.pop(doc_id, None)
+        if previous and (member is None or previous.discord_user_id != member.discord_user_id):
+            self.columns.discard(previous.discord_user_id)
+        if member:
+            self.members[doc_id] = member
+            self.columns.update(member)
+
+    def fetch_reward_points(self, database, category='seeding_tracker'):
+        """
+        Returns the cached reward points while the config document's MONGODB_UPDATED_FIELD
+        is unchanged, and re-reads them through fetch_reward_needed_points otherwise.
+        A config document without the field is read in full every cycle, without the
+        version check, until the next full resync looks for the field again.
+        """
+        if self.reward_unversioned and self.cycles_since_resync != 0:
+            return fetch_reward_needed_points(database, category)
+
+        try:
+            stamp = database['configs'].find_one({'category': category}, {'_id': 1, self.updated_field: 1})
+        except mongo_errors.PyMongoError as err:
+            logger.error(f'MongoDB error during config version check: {err}')
+            return fetch_reward_needed_points(database, category)
+
+        version = (stamp['_id'], stamp.get(self.updated_field)) if stamp else None
+        self.reward_unversioned = version is not None and version[1] is None
+        if version is not None and not self.reward_unversioned and version == self.reward_version:
+            logger.debug('Reward configuration unchanged, using cached points.')
+            return self.reward_points
+
+        self.reward_points = fetch_reward_needed_points(database, category)
+        self.reward_version = version
+        return self.reward_points
+
+incremental_sync = IncrementalSync(config.MONGODB_FULL_RESYNC_CYCLES)
+
+# Columns of the members loaded by full fetches, kept between cycles
+member_columns = None
+
+def refresh_member_columns(members, role_ids):
+    """
+    Brings the member columns of full fetches in line with members, rewriting only the
+    slots of members whose record changed.
+    """
+    global member_columns
+    if member_columns is None or member_columns.role_ids != tuple(role_ids):
+        member_columns = MemberColumns(role_ids)
+    for member in members:
+        member_columns.update(member)
+    member_columns.retain({member.discord_user_id for member in members})
+    return member_columns
+
+def perform_database_operations(role_ids=(), member_filter=None):
+    """
+    Loads the members with ROLE_ID that member_filter accepts, as a list and as
+    MemberColumns with a bitmap of role_ids, and the reward points.
+    """
     try:
         if config.USE_DB_CLONE:
-            run_rsync()
+            with metrics.timer('clone_refresh'):
+                clone_refresher.refresh()
+
+        # When the members' data was captured; the clone holds data from its last refresh
+        snapshot_at = time.time() - (clone_refresher.age() if config.USE_DB_CLONE else 0)
 
         with mongo_connection() as client:
             database = client[config.DATABASE_NAME]
 
-            members = fetch_members_with_role(database)
-            logger.info(f'Fetched {len(members)} members with role {config.ROLE_ID}')
+            if config.MONGODB_INCREMENTAL_SYNC:
+                with metrics.timer('member_fetch'):
+                    members, changed = incremental_sync.sync(database, role_ids, member_filter)
+                columns = incremental_sync.columns
+                logger.info(f'Synced {changed} changed members, {len(members)} members with role {config.ROLE_ID}')
+                with metrics.timer('reward_fetch'):
+                    reward_points = incremental_sync.fetch_reward_points(database)
+            else:
+                with metrics.timer('member_fetch'):
+                    members = fetch_members_with_role(database)
+                    if members is None:
+                        # No columns, so the cycle leaves the hours rollup and the roles alone
+                        return {}
+                    if member_filter:
+                        members = [member for member in members if member_filter(member)]
+                    columns = refresh_member_columns(members, role_ids)
+                changed = len(members)
+                logger.info(f'Fetched {len(members)} members with role {config.ROLE_ID}')
+                with metrics.timer('reward_fetch'):
+                    reward_points = fetch_reward_needed_points(database)
+            metrics.set('members', len(members))
 
-            reward_points = fetch_reward_needed_points(database)
             if reward_points is not None:
                 logger.info(f'Calculated points: {reward_points}')
             else:
@@ -115,7 +474,10 @@ def perform_database_operations():
 
             return {
                 'members': members,
-                'reward_points': reward_points
+                'columns': columns,
+                'changed': changed,
+                'reward_points': reward_points,
+                'snapshot_at': snapshot_at
             }
 
     except Exception as e:
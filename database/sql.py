@@ -1,20 +1,85 @@
 import mysql.connector
+from mysql.connector import pooling
 import logging
+from contextlib import contextmanager
+from threading import Lock
 import config
 
 logger = logging.getLogger(__name__)
 
+_pool = None
+_pool_lock = Lock()
+
+def get_sql_pool():
+    """
+    Returns the shared MySQL connection pool, creating it on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name='whitelister_assistant',
+                    pool_size=config.SQL_POOL_SIZE,
+                    host=config.SQL_HOST,
+                    user=config.SQL_USERNAME,
+                    password=config.SQL_PASSWORD,
+                    database=config.SQL_DATABASE,
+                    port=config.SQL_PORT
+                )
+                logger.info(f'Created SQL connection pool with {config.SQL_POOL_SIZE} connections')
+            except mysql.connector.Error as err:
+                logger.error(f'Error connecting to SQL database: {err}')
+                raise err
+        return _pool
+
 def connect_to_sql():
+    """
+    Borrows a connection from the pool. The connection is pinged first and reconnected if
+    the server dropped it. Closing the connection returns it to the pool.
+    """
     try:
-        cnx = mysql.connector.connect(
-            host=config.SQL_HOST,
-            user=config.SQL_USERNAME,
-            password=config.SQL_PASSWORD,
-            database=config.SQL_DATABASE,
-            port=config.SQL_PORT
-        )
-        logger.info('Connected successfully to SQL database')
+        cnx = get_sql_pool().get_connection()
+        cnx.ping(reconnect=True, attempts=config.SQL_RECONNECT_ATTEMPTS, delay=1)
+        logger.debug('Borrowed a connection from the SQL pool')
         return cnx
     except mysql.connector.Error as err:
         logger.error(f'Error connecting to SQL database: {err}')
         raise err
+
+@contextmanager
+def sql_connection():
+    cnx = connect_to_sql()
+    try:
+        yield cnx
+    finally:
+        cnx.close()
+        logger.debug('Returned connection to the SQL pool')
+
+SESSIONS_TABLE = 'ActivityTracker_PlayerSessions'
+
+def check_sessions_index(cnx):
+    """
+    Warns when the sessions table has no index leading with steamID that also covers
+    joinTime and leaveTime, which the member-filtered hours query relies on.
+    """
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute(f'SHOW INDEX FROM {SESSIONS_TABLE}')
+        indexes = {}
+        for row in cursor.fetchall():
+            indexes.setdefault(row['Key_name'], []).append((row['Seq_in_index'], row['Column_name']))
+    finally:
+        cursor.close()
+
+    for key_name, columns in indexes.items():
+        names = [name for _, name in sorted(columns)]
+        if names[:1] == ['steamID'] and {'joinTime', 'leaveTime'} <= set(names[:3]):
+            logger.info(f'Using index {key_name} on {SESSIONS_TABLE} for the hours rollup.')
+            return True
+
+    logger.warning(
+        f'No (steamID, joinTime, leaveTime) index on {SESSIONS_TABLE}; the hours query will scan the table. '
+        f'Consider: CREATE INDEX idx_steam_join_leave ON {SESSIONS_TABLE} (steamID, joinTime, leaveTime)'
+    )
+    return False
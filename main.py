@@ -1,193 +1,378 @@
+import argparse
 import time
-from datetime import datetime, timedelta
 import logging
 import signal
-import sys
 import threading
-from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
 import config
 from database.mongodb import perform_database_operations
-from database.sql import connect_to_sql
-from role_manager import RoleManager
-from pymongo import errors as mongo_errors
-import mysql.connector
+from database.sql import sql_connection
+from database.hours_rollup import HoursRollup
+from role_manager import RoleManager, RolePlan, RuleEngine, load_rules
 from mysql.connector import Error as mysql_errors
-from utils import initialize_database, run_rsync
+from utils import initialize_database
+from utils.scheduler import AdaptiveScheduler
+from utils.metrics import metrics
+from utils.profiling import CycleProfiler
+from utils.sharding import ShardLease, shard_of, shard_path
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Add a rotating file handler to manage log file size
-handler = RotatingFileHandler(config.LOG_FILE, maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUP_COUNT)
-logger.addHandler(handler)
+# Created by initialize(), so importing this module has no side effects
+log_listener = None
+role_manager = None
+rule_engine = None
+hours_rollup = None
+cycle_executor = None
+scheduler = None
+shard_lease = None
 
-# Initialize the database and create the timers table if it doesn't exist
-initialize_database()
-
-# Initialize RoleManager
-role_manager = RoleManager(config.GUILD_ID)
+# Member columns and metric sources seen by the last cycle
+last_snapshot = {'columns': None, 'sources': None}
 
 # Create a shutdown event
 shutdown_event = threading.Event()
 
+def setup_logging():
+    """
+    Logs at LOG_LEVEL to stderr, and to a rotating LOG_FILE written on a background thread
+    behind a queue.
+    """
+    global log_listener
+    logging.basicConfig(level=config.LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+    handler = RotatingFileHandler(config.LOG_FILE, maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUP_COUNT)
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, handler)
+    log_listener.start()
+    logger.addHandler(QueueHandler(log_queue))
+
+def in_shard(member):
+    return shard_of(member.discord_user_id, config.SHARD_COUNT) == shard_lease.shard
+
+def share_rate_limit(active_shards):
+    # Active shards split the role API budget evenly
+    rate = config.API_RATE_LIMIT / max(1, active_shards)
+    role_manager.api_client.set_rate_limit(rate)
+    metrics.set('active_shards', active_shards)
+    logger.debug(f'{active_shards} active shards, role API rate limit set to {rate:.2f}/s.')
+
+def initialize():
+    """
+    Sets up logging, the local store and the components a cycle needs. In sharded mode
+    it first waits for a shard lease, and returns False if shutdown comes first.
+    """
+    global role_manager, rule_engine, hours_rollup, cycle_executor, scheduler, shard_lease
+    setup_logging()
+
+    # Each shard keeps its own local store, so timers and the outbox have a single owner
+    if config.SHARD_COUNT > 1:
+        if config.USE_DB_CLONE:
+            # Every worker would stop, copy over and restart the same clone
+            raise ValueError('Sharded workers cannot refresh a MongoDB clone; set USE_DB_CLONE=False '
+                             'and read MongoDB directly or a clone refreshed outside the bot.')
+        shard_lease = ShardLease(config.SHARD_LEASE_PATH, config.SHARD_COUNT, config.SHARD_LEASE_TTL)
+        if shard_lease.acquire(shutdown_event) is None:
+            return False
+        config.TIMERS_DB_PATH = shard_path(config.TIMERS_DB_PATH, shard_lease.shard)
+        # Workers on one host each export their own shard's metrics
+        metrics.const_labels['shard'] = str(shard_lease.shard)
+        if config.METRICS_PORT:
+            config.METRICS_PORT += shard_lease.shard
+        if config.METRICS_TEXTFILE:
+            config.METRICS_TEXTFILE = shard_path(config.METRICS_TEXTFILE, shard_lease.shard)
+
+    # Initialize the database and create the timers table if it doesn't exist
+    initialize_database()
+
+    # Initialize RoleManager
+    role_manager = RoleManager(config.GUILD_ID)
+
+    # Role rules, evaluated together in one pass over the members of each cycle
+    rule_engine = RuleEngine(load_rules(), role_manager.timers)
+
+    # Local rollup of hours played, stored next to the timers
+    hours_rollup = HoursRollup(role_manager.store)
+
+    # Runs the MongoDB and SQL fetches of a cycle side by side
+    cycle_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cycle')
+
+    # Stretches the polling interval on quiet cycles and shrinks it on busy ones
+    scheduler = AdaptiveScheduler(config.SLEEP_DURATION, config.SLEEP_MIN_DURATION, config.SLEEP_MAX_DURATION)
+
+    if shard_lease:
+        shard_lease.keep_alive(shutdown_event, share_rate_limit)
+    return True
+
+def shutdown():
+    if cycle_executor:
+        cycle_executor.shutdown(wait=True)
+    if role_manager:
+        role_manager.store.close()
+    if shard_lease and shard_lease.shard is not None:
+        shard_lease.release()
+    logger.info('Program is exiting.')
+    log_listener.stop()
+
 def signal_handler(signum, frame):
     logger.info(f"Signal {signum} received, shutting down gracefully.")
     shutdown_event.set()
 
-# Register signal handlers for graceful shutdown
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
-
-def handle_seeding_points(members_data, reward_points):
+def install_signal_handlers():
+    # Register signal handlers for graceful shutdown
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+
+def log_user_ids(outcome, user_ids):
+    """
+    Logs how many users had an outcome at INFO, with a sample of LOG_ID_SAMPLE IDs when
+    set. The full list is only formatted when DEBUG is enabled.
+    """
+    if config.LOG_ID_SAMPLE:
+        logger.info("%d users %s, e.g. %s", len(user_ids), outcome, user_ids[:config.LOG_ID_SAMPLE])
+    else:
+        logger.info("%d users %s.", len(user_ids), outcome)
+    logger.debug("Users that %s: %s", outcome, user_ids)
+
+def handle_role_rules(columns, sources, plan):
     try:
-
-        timers = role_manager.load_timers()
-
-        users_to_assign = []
-        users_removed = []
-        users_with_timers = []
-        users_unchanged = []
-
-        for doc in members_data:
-            discord_user_id = doc['discord_user_id']
-            user_roles = doc.get('discord_roles_ids', [])
-            seeding_points = doc.get('seeding_points', 0)
-
-            # Check if a timer already exists for this user
-            existing_timer = next((t for t in timers if t[0] == discord_user_id), None)
-            expiration_time = datetime.fromisoformat(existing_timer[2]) if existing_timer else None
-
-            if seeding_points > reward_points and config.SEED_ROLE_ID not in user_roles:
-                users_to_assign.append(discord_user_id)
-                role_manager.add_role(discord_user_id, config.SEED_ROLE_ID)
-                if existing_timer:
-                    role_manager.cancel_timer(discord_user_id)
-            elif seeding_points <= reward_points and config.SEED_ROLE_ID in user_roles:
-                if expiration_time and datetime.now() > expiration_time:
-                    role_manager.remove_role(discord_user_id, config.SEED_ROLE_ID, remove_timer=True)
-                    logger.debug(f"Timer for user {discord_user_id} has expired, role removed.")
-                    users_removed.append(discord_user_id)
-                elif not existing_timer:
-                    users_with_timers.append(discord_user_id)
-                    role_manager.start_timer(discord_user_id, config.SEED_ROLE_ID)
-                else:
-                    users_with_timers.append(discord_user_id)
-                    expiration_time_str = existing_timer[2] if existing_timer else 'N/A'
-                    logger.debug(f"Timer already exists for user {discord_user_id}, expiring at {expiration_time_str}, skipping.")
-            else:
-                users_unchanged.append(discord_user_id)
-
-        logger.info(f"Processed {len(members_data)} users for seeding points.")
-        logger.info(f"{len(users_to_assign)} users had roles assigned: {users_to_assign}")
-        logger.info(f"{len(users_removed)} users were removed: {users_removed}")
-        logger.info(f"{len(users_with_timers)} users have timers: {users_with_timers}")
-        logger.info(f"{len(users_unchanged)} users were unchanged: {users_unchanged}")
+        outcomes = rule_engine.evaluate(columns, sources, plan)
+        for rule_name, outcome in outcomes.items():
+            logger.info("Processed %d users for rule %s.", len(columns), rule_name)
+            log_user_ids("had roles assigned", outcome['assigned'])
+            log_user_ids("were removed", outcome['removed'])
+            if outcome['timed']:
+                log_user_ids("have timers", outcome['timed'])
+            logger.info("%d users were unchanged.", outcome['unchanged'])
 
     except Exception as err:
-        logger.error(f'An error occurred in handle_seeding_points: {err}')
+        logger.error(f'An error occurred in handle_role_rules: {err}')
 
-def handle_hours_played(members_data):
+def refresh_hours_played():
+    """
+    Tops up the hours rollup with the sessions of tracked players closed since the last
+    cycle. Returns whether the refresh succeeded.
+    """
     try:
-        # Connect to SQL database
-        sql_cnx = connect_to_sql()
-        cursor = sql_cnx.cursor(dictionary=True)
-
-        # Calculate the time window for the past 'n' weeks
-        weeks_ago = datetime.now() - timedelta(weeks=config.HOURS_PLAYED_WEEKS)
-
-        # Query to get total hours played in the past week per user
-        query = """
-        SELECT
-            steamID,
-            IFNULL(SUM(TIMESTAMPDIFF(SECOND, joinTime, leaveTime)) / 3600, 0) AS hours_played
-        FROM
-            ActivityTracker_PlayerSessions
-        WHERE
-            joinTime >= %s
-        GROUP BY
-            steamID
-        """
-
-        cursor.execute(query, (weeks_ago,))
-        hours_data = cursor.fetchall()
-
-        if not hours_data:
-            logger.info('No player activity data found for the past week.')
-            return
-
-        # Map Steam IDs to hours played
-        steam_hours_map = {row['steamID']: row['hours_played'] for row in hours_data}
-
-        users_to_assign = []
-        users_removed = []
-        users_unchanged = []
-
-        for user in members_data:
-            steam_id = user.get('steamid64')
-
-            if not steam_id:
-                logger.debug(f"User {user['discord_user_id']} does not have a linked Steam ID.")
-                continue
-
-            discord_user_id = user['discord_user_id']
-            user_roles = user.get('discord_roles_ids', [])
-            hours_played = steam_hours_map.get(steam_id, 0) # Defaults to 0 if not found on
-
-
-            if hours_played >= config.HOURS_THRESHOLD and config.ACTIVITY_ROLE_ID not in user_roles:
-                users_to_assign.append(discord_user_id)
-                role_manager.add_role(discord_user_id, config.ACTIVITY_ROLE_ID)
-            elif hours_played < config.HOURS_THRESHOLD and config.ACTIVITY_ROLE_ID in user_roles:
-                users_removed.append(discord_user_id)
-                role_manager.remove_role(discord_user_id, config.ACTIVITY_ROLE_ID)
-            else:
-                users_unchanged.append(discord_user_id)
+        # Borrow a pooled SQL connection; this runs while the members load from MongoDB
+        with sql_connection() as sql_cnx:
+            hours_rollup.refresh(sql_cnx)
+        return True
 
-        logger.info(f"Processed {len(members_data)} users for hours played.")
-        logger.info(f"{len(users_to_assign)} users had roles assigned: {users_to_assign}")
-        logger.info(f"{len(users_removed)} users were removed: {users_removed}")
-        logger.info(f"{len(users_unchanged)} users were unchanged: {users_unchanged}")
+    except mysql_errors as err:
+        logger.error(f'SQL error in refresh_hours_played: {err}')
+    except Exception as err:
+        logger.error(f'An error occurred in refresh_hours_played: {err}')
+    return False
+
+def fetch_hours_played(columns):
+    """
+    Brings the hours rollup in line with the members' Steam IDs and returns hours played
+    per Steam ID, or None when the data could not be loaded.
+    """
+    try:
+        steam_ids = {steam_id for steam_id in columns.steam_ids if steam_id}
+        with sql_connection() as sql_cnx:
+            hours_rollup.track(sql_cnx, steam_ids)
+        return hours_rollup.hours_by_steam_id()
 
     except mysql_errors as err:
-        logger.error(f'SQL error in handle_hours_played: {err}')
-    except mongo_errors.PyMongoError as err:
-        logger.error(f'MongoDB error in handle_hours_played: {err}')
+        logger.error(f'SQL error in fetch_hours_played: {err}')
     except Exception as err:
-        logger.error(f'An error occurred in handle_hours_played: {err}')
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'sql_cnx' in locals():
-            sql_cnx.close()
-            logger.info('Connection to SQL database closed')
+        logger.error(f'An error occurred in fetch_hours_played: {err}')
+    return None
+
+def handle_expired_timers():
+    """
+    Removes roles whose timers have expired, without waiting for the next full cycle.
+    Members are checked against the snapshot from the last cycle, and users who meet the
+    role's rule again or no longer hold the role only lose their timer. Without a
+    snapshot, or when the rule can't be checked, the timer is left to the next full cycle.
+    """
+    expired = role_manager.pop_expired(time.time())
+    if not expired:
+        return
+
+    columns = last_snapshot['columns']
+    sources = last_snapshot['sources']
+    if not columns or sources is None:
+        logger.info(f'{len(expired)} timers expired with no member snapshot, leaving them to the next cycle.')
+        return
+
+    plan = RolePlan(role_manager.timers)
+    for user_id, role_id in expired:
+        member = columns.get(user_id)
+        rule = rule_engine.rules_by_role.get(role_id)
+        if member and role_id not in member.discord_roles_ids:
+            plan.cancel_timer(user_id, role_id)
+            continue
+        qualifies = rule_engine.qualifies(rule, member, sources) if member and rule else False
+        if qualifies is None:
+            logger.debug("Timer for user %s, role %s expired but the rule can't be checked, left to the next cycle.", user_id, role_id)
+        elif qualifies:
+            plan.cancel_timer(user_id, role_id)
+        else:
+            plan.remove_role(user_id, role_id, remove_timer=True)
+
+    logger.info(f'{len(expired)} timers expired, role plan: {plan.report()}')
+    if config.DRY_RUN:
+        return
+
+    with role_manager.store.transaction():
+        role_manager.execute_plan(plan)
+    role_manager.outbox.drain(shutdown_event)
+
+def wait_for_next_cycle(delay):
+    """
+    Sleeps until the next cycle is due, waking up for every timer expiration on the way.
+    """
+    next_cycle = time.monotonic() + delay
+    while not shutdown_event.is_set():
+        wait = next_cycle - time.monotonic()
+        next_expiration = role_manager.next_expiration()
+        if next_expiration is not None:
+            wait = min(wait, next_expiration - time.time())
+        if wait > 0 and shutdown_event.wait(timeout=wait):
+            return
+        if time.monotonic() >= next_cycle:
+            return
+        handle_expired_timers()
+
+def publish_metrics():
+    metrics.set('live_timers', len(role_manager.timers))
+    for lane, pending in role_manager.outbox.pending_by_lane().items():
+        metrics.set('outbox_pending', pending, lane=lane)
+    metrics.set('poll_interval_seconds', scheduler.interval)
+    role_manager.latency.publish()
+    metrics.set('cycle_overruns', scheduler.overruns)
+    if config.METRICS_TEXTFILE:
+        try:
+            metrics.write_textfile(config.METRICS_TEXTFILE)
+        except OSError as err:
+            logger.error(f'Failed to write metrics textfile: {err}')
 
 def main():
+    """
+    Runs one cycle and returns how many role and timer changes it made.
+    """
+    # Fetch from MongoDB and SQL concurrently; hours are only fetched when a rule uses them
+    mongo_future = cycle_executor.submit(perform_database_operations, rule_engine.role_ids, in_shard if shard_lease else None)
+    hours_future = cycle_executor.submit(refresh_hours_played) if rule_engine.uses('hours_played') else None
+
+    db_results = mongo_future.result()
+    if shutdown_event.is_set():
+        return 0
 
-    # Fetch data from mongodb
-    db_results = perform_database_operations()
-    
     # Extract variables from the returned dictionary
-    members_data = db_results.get('members', [])
+    columns = db_results.get('columns')
     reward_points = db_results.get('reward_points', 115)
-
-    logger.info(f'Number of Members: {len(members_data)}')
+    if columns is None:
+        logger.info('No member data this cycle, skipping rule evaluation.')
+
+    member_count = len(columns) if columns is not None else 0
+    if shard_lease:
+        logger.info(f'Number of Members: {member_count} in shard {shard_lease.shard} of {config.SHARD_COUNT}')
+    else:
+        logger.info(f'Number of Members: {member_count}')
+    logger.info(f'Members Changed Since Last Cycle: {db_results.get("changed", 0)}')
     logger.info(f'Points Needed for Reward: {reward_points}')
 
-    # Handle seeding points and roles
-    handle_seeding_points(members_data, reward_points)
-
-    # Handle hours played and roles
-    handle_hours_played(members_data)
-
-if __name__ == '__main__':
-
+    # Every metric source is fetched once per cycle, however many rules use it
+    hours_refreshed = hours_future.result() if hours_future else False
+    sources = {
+        'reward_points': reward_points,
+        'hours_played': fetch_hours_played(columns) if columns is not None and hours_refreshed else None,
+    }
+
+    # Kept for timer expirations handled between cycles
+    last_snapshot['columns'] = columns
+    last_snapshot['sources'] = sources
+
+    # Collect the role changes of every rule before running any of them
+    plan = RolePlan(role_manager.timers, db_results.get('snapshot_at'))
+    if columns is not None:
+        with metrics.timer('evaluation'):
+            handle_role_rules(columns, sources, plan)
+
+    logger.info(f'Role plan: {plan.report()}')
+    summary = plan.summary()
+    changes = summary['api_calls'] + summary['timer_starts'] + summary['timer_cancels']
+    if config.DRY_RUN:
+        logger.info('Dry run enabled, role plan not executed.')
+        return changes
+
+    # Operations no longer planned have shown up in MongoDB and needn't be held back;
+    # a cycle without members can't tell
+    if columns is not None:
+        role_manager.pending_operations.reconcile(plan)
+
+    # Timer writes and the outbox records of this cycle land in a single commit
+    with role_manager.store.transaction():
+        role_manager.execute_plan(plan)
+    # Held back operations aren't changes, so a cycle of only those counts as quiet
+    changes -= role_manager.pending_operations.held_back
+
+    # Send the queued role operations, including retries that have come due
+    # Draining checks shutdown_event between batches of OUTBOX_BATCH_SIZE operations
+    role_manager.outbox.drain(shutdown_event)
+    return changes
+
+def run_cycle(profiler=None):
+    scheduler.cycle_started()
+    with metrics.timer('cycle'):
+        if profiler:
+            with profiler:
+                changes = main()
+        else:
+            changes = main()
+    publish_metrics()
+    return changes
+
+def run(profiler=None):
+    """
+    Runs cycles until shutdown, waiting between them as the scheduler decides.
+    """
+    if config.METRICS_PORT:
+        metrics.serve(config.METRICS_PORT)
+    # A dry run leaves the outbox of earlier runs unsent
+    if config.DRY_RUN:
+        logger.info(f'Dry run enabled, {role_manager.outbox.pending_count()} pending role operations not resumed.')
+    else:
+        role_manager.resume_outbox(shutdown_event)
+    while not shutdown_event.is_set():
+        changes = run_cycle(profiler)
+        # Wait for the next cycle or until shutdown_event is set
+        wait_for_next_cycle(scheduler.cycle_finished(changes))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Assign Discord roles from seeding points and hours played.')
+    parser.add_argument('command', nargs='?', choices=['run', 'once'], default='run',
+                        help='run: cycle until stopped (default); once: run a single cycle and exit')
+    parser.add_argument('--dry-run', action='store_true', help='Plan role changes without calling the API or writing timers')
+    parser.add_argument('--profile', choices=['cpu', 'memory'],
+                        help='Profile each cycle with cProfile (cpu) or tracemalloc (memory)')
+    parser.add_argument('--profile-output', default='profile.txt', help='File the sorted profile stats are written to')
+    return parser.parse_args(argv)
+
+def cli(argv=None):
+    args = parse_args(argv)
+    if args.dry_run:
+        config.DRY_RUN = True
+    profiler = CycleProfiler(args.profile, args.profile_output) if args.profile else None
+
+    install_signal_handlers()
     try:
-        while not shutdown_event.is_set():
-            main()
-            # Wait for 180 seconds or until shutdown_event is set
-            shutdown_event.wait(timeout=config.SLEEP_DURATION)
+        # Only false when shutdown came while waiting for a shard
+        if initialize():
+            if args.command == 'once':
+                run_cycle(profiler)
+            else:
+                run(profiler)
     except Exception as e:
         logger.error(f'An error occurred: {e}')
     finally:
-        logger.info('Program is exiting.')
\ No newline at end of file
+        shutdown()
+
+if __name__ == '__main__':
+    cli()
@@ -1 +1,3 @@
 from .role_manager import RoleManager
+from .planner import RolePlan
+from .rules import Rule, RuleEngine, load_rules
@@ -0,0 +1,87 @@
+import logging
+import time
+import numpy as np
+import config
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LATENCY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS role_latency (
+    lane TEXT,
+    seen_at REAL,
+    queued_at REAL,
+    confirmed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_role_latency_confirmed ON role_latency (confirmed_at);
+'''
+
+QUANTILES = (50, 95, 99)
+
+# Stages of a role change: seen in the data until queued, queued until the API confirmed
+# it, and the two together
+STAGES = {
+    'detect': lambda seen, queued, confirmed: queued - seen,
+    'deliver': lambda seen, queued, confirmed: confirmed - queued,
+    'total': lambda seen, queued, confirmed: confirmed - seen,
+}
+
+class LatencyTracker:
+    """
+    Records when each confirmed role change was first seen in the member data, queued in
+    the outbox and confirmed by the API, and summarizes the propagation latency per lane
+    over the last LATENCY_WINDOW seconds.
+    The first sighting is the capture time of the data, so clone staleness is included.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.store.execute_script(LATENCY_SCHEMA)
+
+    def record(self, rows):
+        """
+        Stores (lane, seen_at, queued_at, confirmed_at) rows of confirmed operations.
+        """
+        self.store.executemany(
+            'INSERT INTO role_latency (lane, seen_at, queued_at, confirmed_at) VALUES (?, ?, ?, ?)',
+            rows
+        )
+
+    def percentiles(self):
+        """
+        Returns {lane: {stage: {quantile: seconds}, 'count': n}} over the window, and drops
+        records that have left it.
+        """
+        since = time.time() - config.LATENCY_WINDOW
+        self.store.execute('DELETE FROM role_latency WHERE confirmed_at < ?', (since,))
+        rows = self.store.query(
+            'SELECT lane, seen_at, queued_at, confirmed_at FROM role_latency WHERE confirmed_at >= ?',
+            (since,)
+        )
+
+        by_lane = {}
+        for lane, *times in rows:
+            by_lane.setdefault(lane, []).append(times)
+
+        summary = {}
+        for lane, times in by_lane.items():
+            seen, queued, confirmed = np.array(times, dtype=np.float64).T
+            summary[lane] = {'count': len(times)}
+            for stage, latency in STAGES.items():
+                values = np.percentile(latency(seen, queued, confirmed), QUANTILES)
+                summary[lane][stage] = dict(zip(QUANTILES, values.tolist()))
+        return summary
+
+    def publish(self):
+        """
+        Logs the total latency percentiles per lane and exports every stage as metrics.
+        """
+        for lane, summary in self.percentiles().items():
+            for stage in STAGES:
+                for quantile, seconds in summary[stage].items():
+                    metrics.set('role_propagation_seconds', seconds, lane=lane, stage=stage, quantile=str(quantile / 100))
+            metrics.set('role_propagation_count', summary['count'], lane=lane)
+            total = summary['total']
+            logger.info(
+                f"Role propagation for {lane} over {summary['count']} changes: "
+                f"p50 {total[50]:.0f}s, p95 {total[95]:.0f}s, p99 {total[99]:.0f}s."
+            )
@@ -0,0 +1,212 @@
+import logging
+import time
+from collections import deque
+import config
+from utils.api import RoleOperation
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    action TEXT,
+    guild_id TEXT,
+    user_id TEXT,
+    role_id TEXT,
+    timestamp TEXT,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at REAL,
+    created_at REAL,
+    completed_at REAL,
+    last_error TEXT,
+    lane TEXT,
+    seen_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_outbox_user_role ON outbox (user_id, role_id, status);
+'''
+
+# Priority lanes, highest first: roles members just earned, removals after a grace timer
+# ran out, and removals correcting roles members no longer qualify for
+LANES = ('grant', 'expire', 'correct')
+
+def lane_of(op):
+    if op.action == 'add':
+        return 'grant'
+    return 'expire' if op.timestamp else 'correct'
+
+class Outbox:
+    """
+    Durable queue of role operations stored next to the timers. Operations are recorded
+    before they are sent, retried with exponential backoff, and only marked done once the
+    API confirms them, so pending work survives API outages and restarts.
+    Statuses: pending, done, failed (out of attempts) and superseded (replaced by a newer
+    operation for the same user and role).
+    Operations wait in priority lanes (LANES). Each batch takes OUTBOX_LANE_WEIGHTS
+    operations from every lane in turn, highest priority first, so grants go out first
+    without starving the other lanes. A lane holds at most OUTBOX_LANE_DEPTH pending
+    operations.
+    Confirmed operations are reported to the latency tracker, if one is given.
+    """
+    def __init__(self, store, api_client, latency=None):
+        self.store = store
+        self.api_client = api_client
+        self.latency = latency
+        with self.store.transaction():
+            self.store.execute_script(OUTBOX_SCHEMA)
+            columns = {row[1] for row in self.store.query('PRAGMA table_info(outbox)')}
+            if 'seen_at' not in columns:
+                self.store.execute('ALTER TABLE outbox ADD COLUMN seen_at REAL')
+            if 'lane' not in columns:
+                self.store.execute('ALTER TABLE outbox ADD COLUMN lane TEXT')
+                self.store.execute(
+                    "UPDATE outbox SET lane = CASE WHEN action = 'add' THEN 'grant' "
+                    "WHEN timestamp IS NOT NULL THEN 'expire' ELSE 'correct' END"
+                )
+            self.store.execute('CREATE INDEX IF NOT EXISTS idx_outbox_lane ON outbox (status, lane, next_attempt_at)')
+
+    def enqueue(self, operations, seen_at=None, first_seen=None):
+        """
+        Records operations as pending, with seen_at as the time their change was first seen,
+        or the time first_seen holds for their (user_id, role_id, action). An identical
+        pending operation is kept as is, with its attempts, backoff and first sighting, and
+        a pending opposite one is superseded.
+        Returns the operations left out because their lane is full.
+        """
+        now = time.time()
+        seen_at = now if seen_at is None else seen_at
+        first_seen = first_seen or {}
+        self.store.executemany(
+            "UPDATE outbox SET status = 'superseded' WHERE status = 'pending' AND user_id = ? AND role_id = ? AND action != ?",
+            [(op.user_id, op.role_id, op.action) for op in operations]
+        )
+
+        pending = self.pending_by_lane()
+        room = {lane: config.OUTBOX_LANE_DEPTH[lane] - pending[lane] for lane in LANES}
+        accepted = []
+        deferred = []
+        for op in operations:
+            lane = lane_of(op)
+            if room[lane] > 0:
+                room[lane] -= 1
+                accepted.append((lane, op))
+            else:
+                deferred.append(op)
+                metrics.inc('role_operations_deferred_total', lane=lane)
+        if deferred:
+            logger.warning(f'Outbox lanes are full, deferred {len(deferred)} role operations to a later cycle.')
+
+        self.store.executemany(
+            '''
+            INSERT INTO outbox (action, guild_id, user_id, role_id, timestamp, next_attempt_at, created_at, lane, seen_at)
+            SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM outbox WHERE status = 'pending' AND user_id = ? AND role_id = ? AND action = ?
+            )
+            ''',
+            [
+                (op.action, op.guild_id, op.user_id, op.role_id, op.timestamp, now, now, lane,
+                 first_seen.get((op.user_id, op.role_id, op.action), seen_at),
+                 op.user_id, op.role_id, op.action)
+                for lane, op in accepted
+            ]
+        )
+        return deferred
+
+    def pending_count(self):
+        """
+        Returns the number of operations still waiting to be confirmed.
+        """
+        return self.store.query("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")[0][0]
+
+    def pending_by_lane(self):
+        counts = dict.fromkeys(LANES, 0)
+        counts.update(self.store.query("SELECT lane, COUNT(*) FROM outbox WHERE status = 'pending' GROUP BY lane"))
+        return counts
+
+    def _due(self, lane, limit, due_by):
+        return self.store.query(
+            '''
+            SELECT id, attempts, lane, created_at, COALESCE(seen_at, created_at),
+                   action, guild_id, user_id, role_id, timestamp FROM outbox
+            WHERE status = 'pending' AND lane = ? AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+            ''',
+            (lane, due_by, limit)
+        )
+
+    def _next_batch(self, limit, due_by):
+        # Weighted round-robin over the lanes; a lane with nothing due leaves its share
+        # to the others
+        queues = {lane: deque(self._due(lane, limit, due_by)) for lane in LANES}
+        batch = []
+        while len(batch) < limit and any(queues.values()):
+            for lane in LANES:
+                for _ in range(max(1, config.OUTBOX_LANE_WEIGHTS[lane])):
+                    if not queues[lane] or len(batch) >= limit:
+                        break
+                    batch.append(queues[lane].popleft())
+        return batch
+
+    def drain(self, stop_event=None):
+        """
+        Sends the operations due when the drain starts in batches and records the outcomes.
+        Failed operations are rescheduled past the start, so each one is tried at most once
+        per drain, however long its batches take.
+        Returns (sent, failed).
+        """
+        due_by = time.time()
+        sent = failed = 0
+        waits = {lane: [] for lane in LANES}
+        latencies = []
+        while stop_event is None or not stop_event.is_set():
+            rows = self._next_batch(config.OUTBOX_BATCH_SIZE, due_by)
+            if not rows:
+                break
+
+            results = self.api_client.submit_batch([RoleOperation(*row[5:]) for row in rows])
+            now = time.time()
+            with self.store.transaction():
+                for (row_id, attempts, lane, created_at, seen_at, *_), result in zip(rows, results):
+                    metrics.inc('role_operations_total', action=result.operation.action, result='ok' if result.ok else 'error')
+                    if result.ok:
+                        sent += 1
+                        # Time from being queued to being confirmed, retries included
+                        waits[lane].append(now - created_at)
+                        metrics.summary('outbox_wait_seconds', now - created_at, lane=lane)
+                        latencies.append((lane, seen_at, created_at, now))
+                        self.store.execute(
+                            "UPDATE outbox SET status = 'done', attempts = ?, completed_at = ? WHERE id = ?",
+                            (attempts + 1, now, row_id)
+                        )
+                        continue
+
+                    failed += 1
+                    attempts += 1
+                    status = 'failed' if attempts >= config.OUTBOX_MAX_ATTEMPTS else 'pending'
+                    backoff = min(config.OUTBOX_BACKOFF_MAX, config.OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+                    self.store.execute(
+                        'UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+                        (status, attempts, now + backoff, result.error or f'HTTP {result.status}', row_id)
+                    )
+                    if status == 'failed':
+                        logger.error(f'Giving up on {result.operation.action} role {result.operation.role_id} '
+                                     f'for user {result.operation.user_id} after {attempts} attempts.')
+                if self.latency:
+                    self.latency.record(latencies)
+                    latencies = []
+
+        self.store.execute(
+            "DELETE FROM outbox WHERE status != 'pending' AND created_at < ?",
+            (time.time() - config.OUTBOX_RETENTION,)
+        )
+        if sent or failed:
+            logger.info(f'Outbox sent {sent} role operations, {failed} failed and will be retried or dropped.')
+            for lane, lane_waits in waits.items():
+                if lane_waits:
+                    metrics.set('outbox_wait_max_seconds', max(lane_waits), lane=lane)
+                    logger.info(f'Outbox lane {lane}: {len(lane_waits)} sent, waited {sum(lane_waits) / len(lane_waits):.1f}s '
+                                f'on average, {max(lane_waits):.1f}s at most.')
+        return sent, failed
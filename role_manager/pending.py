@@ -0,0 +1,109 @@
+import logging
+import time
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class PendingOperations:
+    """
+    Role operations issued recently, keyed by (user_id, role_id). discord_roles_ids in
+    MongoDB can lag behind Discord, so a cycle may plan the same operation again before
+    the change shows up there; such repeats are held back until MongoDB reflects the
+    change or ttl seconds have passed since the operation was issued.
+    """
+    def __init__(self, store, ttl):
+        self.ttl = ttl
+        self.issued = {}  # (user_id, role_id) -> (action, issued_at)
+        self.held_back = 0
+        # (user_id, role_id, action) -> when a cycle first planned the change, kept while it
+        # is planned, so deferrals, hold backs and supersedes don't restart its latency
+        self.first_seen = {
+            (user_id, role_id, action): seen_at
+            for user_id, role_id, action, seen_at in store.query(
+                "SELECT user_id, role_id, action, MIN(COALESCE(seen_at, created_at)) FROM outbox "
+                "WHERE status = 'pending' GROUP BY user_id, role_id, action"
+            )
+        }
+        if ttl:
+            # Operations queued in the outbox before a restart count as issued
+            rows = store.query(
+                "SELECT user_id, role_id, action, created_at FROM outbox "
+                "WHERE status IN ('pending', 'done') AND created_at > ? ORDER BY id",
+                (time.time() - ttl,)
+            )
+            self.issued = {(user_id, role_id): (action, created_at) for user_id, role_id, action, created_at in rows}
+
+    def reconcile(self, plan):
+        """
+        Forgets operations a full cycle's RolePlan no longer plans, as MongoDB now shows
+        their change. Only roles whose rule the plan evaluated are reconciled, as a skipped
+        rule plans nothing. A removal the plan starts a grace timer for instead is kept, as
+        MongoDB still shows the role it took.
+        """
+        for key in list(self.issued):
+            if key[1] not in plan.evaluated_roles:
+                continue
+            action = self.issued[key][0]
+            op = plan.role_changes.get(key)
+            if op is not None and op.action == action:
+                continue
+            if action == 'remove' and plan.timer_changes.get(key, (None,))[0] == 'start':
+                continue
+            del self.issued[key]
+
+        # Changes of users and roles the plan leaves alone have shown up in MongoDB
+        planned = plan.role_changes.keys() | self.issued.keys()
+        self.first_seen = {
+            key: seen_at for key, seen_at in self.first_seen.items()
+            if key[:2] in planned or key[1] not in plan.evaluated_roles
+        }
+
+    def sighted(self, operations, seen_at):
+        """
+        Records seen_at as the first sighting of operations not seen before, and returns
+        the first sightings keyed by (user_id, role_id, action).
+        """
+        for op in operations:
+            key = (op.user_id, op.role_id, op.action)
+            self.first_seen[key] = min(self.first_seen.get(key, seen_at), seen_at)
+        return self.first_seen
+
+    def removing(self, user_id, role_id):
+        """
+        Returns whether a removal of the role was issued within the TTL.
+        """
+        issued = self.issued.get((user_id, role_id))
+        return bool(issued) and issued[0] == 'remove' and time.time() - issued[1] < self.ttl
+
+    def forget(self, operations):
+        """
+        Drops operations that were recorded as issued but never queued.
+        """
+        for op in operations:
+            self.issued.pop((op.user_id, op.role_id), None)
+
+    def filter(self, operations):
+        """
+        Returns the operations to send, holding back those issued within the TTL, and
+        records the rest as issued.
+        """
+        if not self.ttl:
+            return operations
+
+        now = time.time()
+        to_send = []
+        held_back = 0
+        for op in operations:
+            key = (op.user_id, op.role_id)
+            issued = self.issued.get(key)
+            if issued and issued[0] == op.action and now - issued[1] < self.ttl:
+                held_back += 1
+                continue
+            self.issued[key] = (op.action, now)
+            to_send.append(op)
+
+        self.held_back = held_back
+        if held_back:
+            metrics.inc('role_operations_held_back_total', held_back)
+            logger.info(f'Held back {held_back} role operations issued less than {self.ttl}s ago and not yet reflected in MongoDB.')
+        return to_send
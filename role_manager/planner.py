@@ -0,0 +1,81 @@
+import logging
+import time
+import config
+from utils.api import RoleOperation
+
+logger = logging.getLogger(__name__)
+
+class RolePlan:
+    """
+    Role changes and timer writes requested during a cycle, coalesced per user before any
+    of them run. Repeated requests collapse into one operation, and timer deletes for
+    users without a timer are dropped.
+    """
+    def __init__(self, timers, seen_at=None):
+        # The RoleManager timer index, used to resolve timer state at planning time
+        self.timers = timers
+        # When the data the plan is based on was captured, for latency tracking
+        self.seen_at = time.time() if seen_at is None else seen_at
+        self.role_changes = {}   # (user_id, role_id) -> RoleOperation
+        self.timer_changes = {}  # (user_id, role_id) -> ('start', duration) or ('cancel', None)
+        # Roles whose rule was evaluated for every member, so nothing planned means settled
+        self.evaluated_roles = set()
+        # What the same requests would have cost when run inline
+        self.requested_api_calls = 0
+        self.requested_db_writes = 0
+
+    def add_role(self, user_id, role_id):
+        self.requested_api_calls += 1
+        self.requested_db_writes += 1
+        self.role_changes[(user_id, role_id)] = RoleOperation('add', config.GUILD_ID, user_id, role_id, None)
+        # Getting the role back ends its grace timer; timers for other roles are left alone
+        self._cancel_timer(user_id, role_id)
+
+    def remove_role(self, user_id, role_id, remove_timer=False):
+        self.requested_api_calls += 2 if remove_timer else 1
+        timestamp = None
+        if remove_timer:
+            self.requested_db_writes += 1
+            timer = self.timers.get((user_id, role_id))
+            timestamp = timer.start_time if timer else 'No timer found'
+            self._cancel_timer(user_id, role_id)
+        self.role_changes[(user_id, role_id)] = RoleOperation('remove', config.GUILD_ID, user_id, role_id, timestamp)
+
+    def start_timer(self, user_id, role_id, duration=None):
+        self.requested_db_writes += 1
+        self.timer_changes[(user_id, role_id)] = ('start', duration)
+
+    def cancel_timer(self, user_id, role_id):
+        self.requested_db_writes += 1
+        self._cancel_timer(user_id, role_id)
+
+    def _cancel_timer(self, user_id, role_id):
+        # Undo a start planned earlier in this cycle, and only delete timers that exist
+        key = (user_id, role_id)
+        self.timer_changes.pop(key, None)
+        if key in self.timers:
+            self.timer_changes[key] = ('cancel', None)
+
+    def operations(self):
+        return list(self.role_changes.values())
+
+    def summary(self):
+        actions = [op.action for op in self.role_changes.values()]
+        timer_actions = [action for action, _ in self.timer_changes.values()]
+        return {
+            'role_adds': actions.count('add'),
+            'role_removes': actions.count('remove'),
+            'timer_starts': timer_actions.count('start'),
+            'timer_cancels': timer_actions.count('cancel'),
+            'api_calls': len(actions),
+            'api_calls_saved': self.requested_api_calls - len(actions),
+            'db_writes_saved': self.requested_db_writes - len(timer_actions),
+        }
+
+    def report(self):
+        summary = self.summary()
+        return (
+            f"{summary['api_calls']} API calls ({summary['role_adds']} adds, {summary['role_removes']} removes), "
+            f"{summary['timer_starts']} timer starts, {summary['timer_cancels']} timer cancels; "
+            f"coalescing saved {summary['api_calls_saved']} API calls and {summary['db_writes_saved']} timer writes"
+        )
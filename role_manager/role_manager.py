@@ -1,72 +1,133 @@
+import heapq
 import logging
+from collections import namedtuple
 from ratelimiter import RateLimiter
 from threading import Lock
 import requests
 import config
-from utils import execute_db_query, get_api_client
+from database.local_store import get_local_store
+from utils import get_api_client
+from .outbox import Outbox
+from .latency import LatencyTracker
+from .pending import PendingOperations
 from datetime import datetime, timedelta
-import sqlite3
 
 logger = logging.getLogger(__name__)
 
+# In-memory view of a row in the timers table; expiration is in epoch seconds
+Timer = namedtuple('Timer', ['role_id', 'expiration', 'start_time'])
+
 class RoleManager:
     def __init__(self, guild_id):
         # Initialize the API client using the factory function
         self.api_client = get_api_client()
+        self.store = get_local_store()
+        self.latency = LatencyTracker(self.store)
+        self.outbox = Outbox(self.store, self.api_client, self.latency)
+        # Recently issued operations, held back while MongoDB catches up with them
+        self.pending_operations = PendingOperations(self.store, config.PENDING_OP_TTL)
+        # Timer index keyed by (discord_user_id, role_id), loaded once and kept in sync on every write
+        self.timers = {}
+        # Min-heap of (expiration, user_id, role_id); entries whose timer was cancelled or
+        # restarted are skipped lazily when they reach the top
+        self.expiry_heap = []
+        self.load_timers()
 
-    def add_role(self, user_id, role_id):
-        logger.debug(f"Assigning role {role_id} to user {user_id} via API client.")
-        self.api_client.add_role(config.GUILD_ID, user_id, role_id)
-        # Remove any existing timer for the user, as they are getting the role back
-        self.cancel_timer(user_id)
-
-    def remove_role(self, user_id, role_id, remove_timer=False):
-        
-        self.api_client.remove_role(config.GUILD_ID, user_id, role_id)
+    def execute_plan(self, plan):
+        """
+        Records the role operations of a RolePlan in the outbox and applies its timer
+        writes, except those of operations a full lane deferred. Run it inside a store
+        transaction so both land in the same commit, then send the operations with
+        outbox.drain(). Operations issued within PENDING_OP_TTL are held back, and so are
+        grace timers for roles whose removal was.
+        """
+        first_seen = self.pending_operations.sighted(plan.operations(), plan.seen_at)
+        operations = self.pending_operations.filter(plan.operations())
+        deferred = self.outbox.enqueue(operations, plan.seen_at, first_seen)
+        self.pending_operations.forget(deferred)
 
-        if remove_timer:
-            # Retrieve the start time of the timer before removing the role.
-            timer_info = self.get_timer_info(user_id)   
-            start_time = timer_info['start_time'] if timer_info else 'No timer found'
+        # Operations a full lane turned away keep their timers as they are, so a later
+        # cycle plans them again: an expired grace timer keeps its removal due
+        turned_away = {(op.user_id, op.role_id) for op in deferred}
+        for (user_id, role_id), (action, duration) in plan.timer_changes.items():
+            if (user_id, role_id) in turned_away:
+                continue
+            if action == 'start' and self.pending_operations.removing(user_id, role_id):
+                # The role was just removed and MongoDB hasn't caught up, so no grace is due
+                self.pending_operations.held_back += 1
+                continue
+            if action == 'start':
+                self.start_timer(user_id, role_id, duration)
+            else:
+                self.cancel_timer(user_id, role_id)
+        return len(operations) - len(deferred)
 
-            logger.debug(f"Removing role {role_id} from user {user_id} via API client with timestamp {start_time}.")
-            self.api_client.remove_role(config.GUILD_ID, user_id, role_id, start_time)
-            # Delete the timer from the database only if remove_timer is True
-            execute_db_query('DELETE FROM timers WHERE discord_user_id = ?', (user_id,))
+    def resume_outbox(self, stop_event=None):
+        """
+        Sends role operations left pending by a previous run.
+        """
+        pending = self.outbox.pending_count()
+        if pending:
+            logger.info(f"Resuming {pending} pending role operations from the outbox.")
+            self.outbox.drain(stop_event)
 
     def start_timer(self, user_id, role_id, duration=None):
         if duration is None:
             duration = config.TIMER_DURATION
         start_time = datetime.now()
         expiration_time = start_time + timedelta(seconds=duration)
+        expiration = int(expiration_time.timestamp())
 
         # Save timer to the database
-        execute_db_query('REPLACE INTO timers (discord_user_id, role_id, expiration_time, start_time) VALUES (?, ?, ?, ?)',
-                         (user_id, role_id, expiration_time.isoformat(), start_time.isoformat()))
+        self.store.execute('REPLACE INTO timers (discord_user_id, role_id, expiration_time, start_time) VALUES (?, ?, ?, ?)',
+                           (user_id, role_id, expiration, start_time.isoformat()))
+        self.timers[(user_id, role_id)] = Timer(role_id, expiration, start_time.isoformat())
+        heapq.heappush(self.expiry_heap, (expiration, user_id, role_id))
 
         logger.debug(f"Started a timer for user {user_id}, role {role_id}, to expire at {expiration_time.isoformat()}")
 
-    def cancel_timer(self, user_id):
-        execute_db_query('DELETE FROM timers WHERE discord_user_id = ?', (user_id,))
-        logger.debug(f"Cancelled timer for user {user_id}")
+    def cancel_timer(self, user_id, role_id):
+        # The index mirrors the table, so a timer missing from it has nothing to delete
+        if self.timers.pop((user_id, role_id), None) is None:
+            return
+        self.store.execute('DELETE FROM timers WHERE discord_user_id = ? AND role_id = ?', (user_id, role_id))
+        logger.debug(f"Cancelled timer for user {user_id}, role {role_id}")
 
     def load_timers(self):
-        conn = sqlite3.connect('timers.db')
-        c = conn.cursor()
-        c.execute('SELECT discord_user_id, role_id, expiration_time FROM timers')
-        rows = c.fetchall()
-        conn.close()
-        return rows
+        """
+        Loads every timer from the local store into the in-memory index.
+        """
+        rows = self.store.query('SELECT discord_user_id, role_id, expiration_time, start_time FROM timers')
+        self.timers = {
+            (user_id, role_id): Timer(role_id, expiration_time, start_time)
+            for user_id, role_id, expiration_time, start_time in rows
+        }
+        self.expiry_heap = [(timer.expiration, user_id, role_id) for (user_id, role_id), timer in self.timers.items()]
+        heapq.heapify(self.expiry_heap)
+        logger.info(f'Loaded {len(self.timers)} timers into memory.')
+        return self.timers
+
+    def _is_current(self, entry):
+        expiration, user_id, role_id = entry
+        timer = self.timers.get((user_id, role_id))
+        return timer is not None and timer.expiration == expiration
 
-    def get_timer_info(self, user_id):
-        conn = sqlite3.connect('timers.db')
-        c = conn.cursor()
-        c.execute('SELECT start_time FROM timers WHERE discord_user_id = ?', (user_id,))
-        row = c.fetchone()
-        conn.close()
+    def next_expiration(self):
+        """
+        Returns the epoch time of the earliest live timer, or None when there is none.
+        """
+        while self.expiry_heap and not self._is_current(self.expiry_heap[0]):
+            heapq.heappop(self.expiry_heap)
+        return self.expiry_heap[0][0] if self.expiry_heap else None
 
-        if row:
-            return {
-                "start_time": row[0]  # Return the start time directly
-            }
-        return None
+    def pop_expired(self, now):
+        """
+        Removes and returns the (user_id, role_id) of live timers that expired at or before now.
+        The timers themselves stay in place until they are cancelled.
+        """
+        expired = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            entry = heapq.heappop(self.expiry_heap)
+            if self._is_current(entry):
+                expired.append(entry[1:])
+        return expired
@@ -0,0 +1,171 @@
+import json
+import logging
+import time
+from collections import namedtuple
+import numpy as np
+import config
+
+logger = logging.getLogger(__name__)
+
+# A role granted while a member's metric is above threshold. A threshold of None means the
+# reward points from MongoDB. Members who drop below keep the role for grace_seconds, and
+# lose it right away when that is 0.
+Rule = namedtuple('Rule', ['name', 'role_id', 'metric', 'threshold', 'inclusive', 'grace_seconds'])
+
+# Value of each metric for a member, given the sources fetched for the cycle. None means
+# the metric is unknown for that member, and the rule is skipped for them.
+METRICS = {
+    'seeding_points': lambda member, sources: member.seeding_points,
+    'hours_played': lambda member, sources: (
+        sources['hours_played'].get(member.steamid64, 0) if member.steamid64 else None
+    ),
+}
+
+# The same metrics over a MemberColumns snapshot, as (values, known) arrays
+COLUMNS = {
+    'seeding_points': lambda columns, sources: (columns.seeding_points, columns.live),
+    'hours_played': lambda columns, sources: (columns.hours_played(sources['hours_played']), columns.has_steam_id),
+}
+
+# Metrics that depend on a source fetched separately from the members
+METRIC_SOURCES = {'hours_played': 'hours_played'}
+
+def default_rules():
+    """
+    The seed and activity rules described by SEED_ROLE_ID, TIMER_DURATION,
+    ACTIVITY_ROLE_ID and HOURS_THRESHOLD.
+    """
+    rules = []
+    if config.SEED_ROLE_ID:
+        rules.append(Rule('seed', config.SEED_ROLE_ID, 'seeding_points', None, False, config.TIMER_DURATION))
+    if config.ACTIVITY_ROLE_ID:
+        rules.append(Rule('activity', config.ACTIVITY_ROLE_ID, 'hours_played', config.HOURS_THRESHOLD, True, 0))
+    return rules
+
+def load_rules():
+    """
+    Returns the rules from ROLE_RULES, a JSON list of objects with name, role_id, metric
+    and optionally threshold, inclusive and grace_seconds, or the default rules when unset.
+    Each role can have one rule only.
+    """
+    if not config.ROLE_RULES:
+        return check_unique_roles(default_rules())
+
+    rules = []
+    for entry in json.loads(config.ROLE_RULES):
+        rule = Rule(
+            entry.get('name', entry['role_id']),
+            str(entry['role_id']),
+            entry['metric'],
+            entry.get('threshold'),
+            entry.get('inclusive', False),
+            int(entry.get('grace_seconds', 0)),
+        )
+        if rule.metric not in METRICS:
+            raise ValueError(f'Rule {rule.name} uses unknown metric {rule.metric}; expected one of {sorted(METRICS)}')
+        if rule.threshold is None and rule.metric != 'seeding_points':
+            raise ValueError(f'Rule {rule.name} needs a threshold')
+        rules.append(rule)
+    return check_unique_roles(rules)
+
+def check_unique_roles(rules):
+    # The engine, the member columns and the timers key rules by role, so a second rule
+    # for a role would silently replace the first
+    seen = {}
+    for rule in rules:
+        if rule.role_id in seen:
+            raise ValueError(f'Rules {seen[rule.role_id]} and {rule.name} both manage role {rule.role_id}')
+        seen[rule.role_id] = rule.name
+    return rules
+
+class RuleEngine:
+    """
+    Evaluates every role rule in a single pass over the members of a cycle and records
+    the resulting role and timer changes in a RolePlan.
+    """
+    def __init__(self, rules, timers):
+        self.rules = rules
+        # The RoleManager timer index, keyed by (user_id, role_id)
+        self.timers = timers
+        self.rules_by_role = {rule.role_id: rule for rule in rules}
+        # Roles the member columns keep a bitmap of
+        self.role_ids = tuple(self.rules_by_role)
+
+    def uses(self, metric):
+        return any(rule.metric == metric for rule in self.rules)
+
+    def _threshold(self, rule, sources):
+        return sources['reward_points'] if rule.threshold is None else rule.threshold
+
+    def _active_rules(self, sources):
+        # Rules whose source failed to load are skipped for the cycle, rather than
+        # removing the role from everyone
+        active = []
+        for rule in self.rules:
+            source = METRIC_SOURCES.get(rule.metric)
+            if source and not sources.get(source):
+                logger.info(f'No {source} data available, skipping rule {rule.name}.')
+                continue
+            threshold = self._threshold(rule, sources)
+            if threshold is None:
+                logger.info(f'No threshold available, skipping rule {rule.name}.')
+                continue
+            active.append((rule, threshold))
+        return active
+
+    def qualifies(self, rule, member, sources):
+        """
+        Returns whether the member meets the rule, or None when that can't be told.
+        """
+        source = METRIC_SOURCES.get(rule.metric)
+        if source and not sources.get(source):
+            return None
+        value = METRICS[rule.metric](member, sources)
+        threshold = self._threshold(rule, sources)
+        if value is None or threshold is None:
+            return None
+        return value >= threshold if rule.inclusive else value > threshold
+
+    def evaluate(self, columns, sources, plan):
+        """
+        Plans the role changes of every rule for the members in columns, a MemberColumns
+        snapshot with a bitmap of role_ids. Returns the outcomes per rule name: lists of
+        users assigned, removed and on a grace timer, and an unchanged count.
+        """
+        now = time.time()
+        outcomes = {}
+
+        for rule, threshold in self._active_rules(sources):
+            plan.evaluated_roles.add(rule.role_id)
+            values, known = COLUMNS[rule.metric](columns, sources)
+            qualifies = values >= threshold if rule.inclusive else values > threshold
+            has_role = columns.has_role(rule.role_id)
+            assign = known & qualifies & ~has_role
+            drop = known & ~qualifies & has_role
+
+            outcome = {'assigned': [], 'removed': [], 'timed': [], 'unchanged': int(np.count_nonzero(known & ~(assign | drop)))}
+            outcomes[rule.name] = outcome
+
+            # Also cancels the users' grace timers for this role, if any
+            for user_id in columns.select(assign):
+                plan.add_role(user_id, rule.role_id)
+                outcome['assigned'].append(user_id)
+
+            if not rule.grace_seconds:
+                for user_id in columns.select(drop):
+                    plan.remove_role(user_id, rule.role_id)
+                    outcome['removed'].append(user_id)
+                continue
+
+            expirations = columns.timer_expirations(self.timers, rule.role_id)
+            with np.errstate(invalid='ignore'):
+                expired = drop & (expirations < now)
+            for user_id in columns.select(expired):
+                plan.remove_role(user_id, rule.role_id, remove_timer=True)
+                logger.debug("Timer for user %s, role %s has expired, role removal planned.", user_id, rule.role_id)
+                outcome['removed'].append(user_id)
+            for user_id in columns.select(drop & np.isnan(expirations)):
+                plan.start_timer(user_id, rule.role_id, rule.grace_seconds)
+            outcome['timed'] = columns.select(drop & ~expired)
+
+        return outcomes
@@ -0,0 +1,18 @@
+import os
+import sys
+
+# config reads these at import time and has no defaults for them
+os.environ.update({
+    'SQL_PORT': '3306',
+    'HOURS_THRESHOLD': '25',
+    'HOURS_PLAYED_WEEKS': '2',
+    'GUILD_ID': 'test-guild',
+    'ROLE_ID': 'whitelist',
+    'SEED_ROLE_ID': 'seed',
+    'ACTIVITY_ROLE_ID': 'activity',
+    'API_URL': 'http://127.0.0.1:9',
+    'DRY_RUN': 'False',
+    'ROLE_RULES': '',
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,87 @@
+import time
+import pytest
+from benchmarks.stub_api import StubRoleAPI
+from utils.api import RoleOperation, SessionAPIClient, TokenBucket, parse_retry_after
+
+@pytest.fixture
+def stub():
+    stub = StubRoleAPI().start()
+    yield stub
+    stub.stop()
+
+def operations(count, action='add'):
+    return [RoleOperation(action, 'guild', str(user_id), 'seed', None) for user_id in range(count)]
+
+def test_bucket_paces_after_its_capacity():
+    bucket = TokenBucket(rate=20, capacity=2)
+    waits = [bucket.acquire() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert sum(waits) == pytest.approx(0.1, abs=0.05)
+
+def test_bucket_halves_on_throttle_and_recovers():
+    bucket = TokenBucket(rate=8, capacity=1, min_rate=1.5)
+    bucket.throttle()
+    assert bucket.rate == 4
+    bucket.throttle()
+    bucket.throttle()
+    assert bucket.rate == 1.5
+    for _ in range(20):
+        bucket.recover()
+    assert bucket.rate == 8
+
+def test_bucket_pauses_for_retry_after():
+    bucket = TokenBucket(rate=100, capacity=1)
+    bucket.throttle(retry_after=0.3)
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.3
+
+def test_set_max_rate_keeps_a_throttled_bucket_throttled():
+    bucket = TokenBucket(rate=8, capacity=1)
+    bucket.set_max_rate(2)
+    assert (bucket.rate, bucket.max_rate) == (2, 2)
+    bucket.set_max_rate(8)
+    assert bucket.rate == 8
+    bucket.throttle()
+    bucket.set_max_rate(16)
+    assert (bucket.rate, bucket.max_rate) == (4, 16)
+
+def test_parse_retry_after():
+    assert parse_retry_after('2') == 2.0
+    assert parse_retry_after('-1') == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') is None
+
+def test_submit_batch_returns_a_result_per_operation(stub):
+    client = SessionAPIClient(stub.url, rate_limit=1000, max_in_flight=4)
+    ops = operations(10) + operations(5, 'remove')
+    results = client.submit_batch(ops)
+    assert [result.operation for result in results] == ops
+    assert all(result.ok and result.status == 200 for result in results)
+    assert stub.calls == {'/add-role': 10, '/remove-role': 5}
+
+def test_429_with_retry_after_is_retried_after_the_pause(stub):
+    client = SessionAPIClient(stub.url, rate_limit=100, max_in_flight=1)
+    stub.throttle(retry_after=0.3)
+    started = time.monotonic()
+    result = client.execute(operations(1)[0])
+    assert result.ok
+    assert time.monotonic() - started >= 0.3
+    assert stub.calls['/add-role'] == 2
+    # Recovered by a tenth of the ceiling after halving
+    assert client.bucket.rate == pytest.approx(60)
+
+def test_429_past_the_retries_fails_the_operation(stub):
+    client = SessionAPIClient(stub.url, rate_limit=1000, max_in_flight=1, max_retries=2)
+    stub.throttle(count=3, retry_after=0)
+    result = client.execute(operations(1)[0])
+    assert not result.ok
+    assert result.status == 429
+    assert stub.calls['/add-role'] == 3
+
+def test_unreachable_api_fails_without_raising():
+    client = SessionAPIClient('http://127.0.0.1:9', rate_limit=1000, timeout=1)
+    result = client.execute(operations(1)[0])
+    assert not result.ok
+    assert result.status is None
+    assert result.error
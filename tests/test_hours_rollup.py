@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+import mysql.connector
+import pytest
+import config
+from benchmarks.sqlite_sessions import SQLiteSessions
+from database.hours_rollup import HoursRollup
+from database.local_store import LocalStore
+
+NOW = datetime.now().replace(microsecond=0)
+
+def ago(**kwargs):
+    return NOW - timedelta(**kwargs)
+
+class FailingSessions(SQLiteSessions):
+    """
+    Fails the query of the cursor numbered fail_at, counting from 1.
+    """
+    fail_at = None
+    cursors = 0
+
+    def cursor(self, dictionary=False, **kwargs):
+        self.cursors += 1
+        if self.cursors == self.fail_at:
+            raise mysql.connector.Error('Lost connection to MySQL server during query')
+        return super().cursor(dictionary, **kwargs)
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalStore(str(tmp_path / 'timers.db'))
+    store.initialize()
+    yield store
+    store.close()
+
+@pytest.fixture
+def sessions():
+    return SQLiteSessions()
+
+def test_backfill_and_top_up(store, sessions):
+    sessions.load([
+        ('a', ago(hours=5), ago(hours=4)),
+        ('a', ago(hours=3), ago(hours=1)),
+        ('b', ago(hours=2), ago(hours=1, minutes=30)),
+        ('outsider', ago(hours=2), ago(hours=1)),
+        ('a', ago(minutes=30), None),
+    ])
+    rollup = HoursRollup(store)
+    rollup.refresh(sessions)
+    rollup.track(sessions, {'a', 'b'})
+    assert rollup.hours_by_steam_id() == {'a': 3.0, 'b': 0.5}
+
+    # The open session closes
+    sessions.conn.execute('UPDATE ActivityTracker_PlayerSessions SET leaveTime = ? WHERE leaveTime IS NULL',
+                          ((NOW + timedelta(minutes=30)).isoformat(' '),))
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 4.0, 'b': 0.5}
+
+def test_refresh_counts_sessions_inside_the_overlap_once(store, sessions, monkeypatch):
+    monkeypatch.setattr(config, 'SQL_IN_CHUNK_SIZE', 1)
+    sessions.load([('a', ago(hours=3), ago(hours=2))])
+    rollup = HoursRollup(store)
+    rollup.track(sessions, {'a', 'b'})
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0}
+
+    sessions.load([('b', ago(hours=1), ago(minutes=2))])
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0, 'b': 58 / 60}
+
+    # Closed with the same leaveTime as the watermark, and committed late with an earlier one
+    sessions.load([
+        ('a', ago(minutes=20), ago(minutes=2)),
+        ('a', ago(minutes=40), ago(minutes=5)),
+    ])
+    rollup.refresh(sessions)
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0 + 18 / 60 + 35 / 60, 'b': 58 / 60}
+
+def test_new_member_counts_the_overlap_right_away_and_once(store, sessions):
+    sessions.load([('a', ago(hours=2), ago(hours=1))])
+    rollup = HoursRollup(store)
+    rollup.track(sessions, {'a'})
+    rollup.refresh(sessions)
+
+    sessions.load([('b', ago(hours=2), ago(hours=1)), ('b', ago(minutes=30), ago(minutes=1))])
+    rollup.refresh(sessions)
+    rollup.track(sessions, {'a', 'b'})
+    assert rollup.hours_by_steam_id() == {'a': 1.0, 'b': 1.0 + 29 / 60}
+    rollup.refresh(sessions)
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0, 'b': 1.0 + 29 / 60}
+
+def test_players_who_leave_are_dropped(store, sessions):
+    sessions.load([('a', ago(hours=2), ago(hours=1)), ('b', ago(hours=2), ago(minutes=1))])
+    rollup = HoursRollup(store)
+    rollup.track(sessions, {'a', 'b'})
+    rollup.refresh(sessions)
+    rollup.track(sessions, {'a'})
+    assert rollup.hours_by_steam_id() == {'a': 1.0}
+    assert store.query("SELECT COUNT(*) FROM hours_sessions WHERE steam_id = 'b'") == [(0,)]
+
+def test_failed_chunk_leaves_nothing_counted(store, monkeypatch):
+    monkeypatch.setattr(config, 'SQL_IN_CHUNK_SIZE', 1)
+    sessions = FailingSessions()
+    sessions.load([('a', ago(hours=3), ago(hours=2)), ('b', ago(hours=3), ago(hours=2))])
+    rollup = HoursRollup(store)
+
+    # The backfill of 'a' is upserted before the chunk of 'b' fails
+    sessions.fail_at = 2
+    with pytest.raises(mysql.connector.Error):
+        rollup.track(sessions, {'a', 'b'})
+    assert rollup.hours_by_steam_id() == {}
+    sessions.fail_at = None
+    rollup.track(sessions, {'a', 'b'})
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0, 'b': 1.0}
+
+    sessions.load([('a', ago(minutes=8), ago(minutes=3)), ('b', ago(minutes=8), ago(minutes=3))])
+    sessions.fail_at = sessions.cursors + 2
+    with pytest.raises(mysql.connector.Error):
+        rollup.refresh(sessions)
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0 + 5 / 60, 'b': 1.0 + 5 / 60}
+
+def test_first_watermark_follows_the_sessions_clock(store, sessions):
+    # ActivityTracker writes times two hours behind the bot's clock
+    server_now = NOW - timedelta(hours=2)
+    sessions.load([('a', server_now - timedelta(hours=2), server_now - timedelta(hours=1))])
+    rollup = HoursRollup(store)
+    rollup.track(sessions, {'a'})
+    assert rollup.hours_by_steam_id() == {'a': 1.0}
+
+    # Closes after the backfill, but hours before the bot's clock
+    sessions.load([('a', server_now - timedelta(minutes=30), server_now + timedelta(minutes=1))])
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0 + 31 / 60}
+
+def test_first_watermark_without_sessions_starts_at_the_window(store, sessions):
+    rollup = HoursRollup(store)
+    rollup.track(sessions, {'a'})
+    sessions.load([('a', ago(hours=2), ago(hours=1))])
+    rollup.refresh(sessions)
+    assert rollup.hours_by_steam_id() == {'a': 1.0}
@@ -0,0 +1,94 @@
+import threading
+import pytest
+from database.local_store import LocalStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalStore(str(tmp_path / 'timers.db'))
+    store.initialize()
+    yield store
+    store.close()
+
+def timer_users(store):
+    return [user_id for user_id, in store.query('SELECT discord_user_id FROM timers ORDER BY discord_user_id')]
+
+def add_timer(store, user_id):
+    store.execute('INSERT INTO timers (discord_user_id, role_id, expiration_time, start_time) VALUES (?, ?, ?, ?)',
+                  (user_id, 'seed', 0, ''))
+
+def test_transaction_commits(store):
+    with store.transaction():
+        add_timer(store, 'a')
+        add_timer(store, 'b')
+    assert timer_users(store) == ['a', 'b']
+    assert not store.conn.in_transaction
+
+def test_transaction_rolls_back_when_the_block_raises(store):
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            add_timer(store, 'a')
+            raise RuntimeError('fetch failed')
+    assert timer_users(store) == []
+    assert not store.conn.in_transaction
+
+def test_nested_transaction_that_raises_only_undoes_its_own_writes(store):
+    with store.transaction():
+        add_timer(store, 'a')
+        with pytest.raises(RuntimeError):
+            with store.transaction():
+                add_timer(store, 'b')
+                raise RuntimeError('nested failure')
+        add_timer(store, 'c')
+    assert timer_users(store) == ['a', 'c']
+
+def test_nested_failure_rolls_back_everything_when_it_propagates(store):
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            add_timer(store, 'a')
+            with store.transaction():
+                add_timer(store, 'b')
+                raise RuntimeError('nested failure')
+    assert timer_users(store) == []
+
+def test_other_threads_wait_for_an_open_transaction(store):
+    inside = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def writer():
+        try:
+            with store.transaction():
+                add_timer(store, 'a')
+                inside.set()
+                release.wait(5)
+                raise RuntimeError('rolled back')
+        except RuntimeError:
+            pass
+        except Exception as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    inside.wait(5)
+
+    # Starts its own transaction once the writer's block is over, instead of joining it
+    def other_writer():
+        with store.transaction():
+            add_timer(store, 'b')
+    other = threading.Thread(target=other_writer)
+    other.start()
+    other.join(0.2)
+    assert other.is_alive()
+
+    release.set()
+    thread.join(5)
+    other.join(5)
+    assert not errors
+    assert timer_users(store) == ['b']
+
+def test_shard_store_switches_an_existing_store_off_wal(tmp_path):
+    path = str(tmp_path / 'timers.shard0.db')
+    LocalStore(path).close()
+    store = LocalStore(path, 'DELETE')
+    assert store.query('PRAGMA journal_mode') == [('delete',)]
+    store.close()
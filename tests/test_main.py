@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+import mongomock
+import pytest
+import config
+import database.local_store as local_store
+import database.mongodb as mongodb
+import main
+from database.mongodb import MemberColumns, to_member
+from role_manager import RoleManager, RuleEngine, load_rules
+from benchmarks.sqlite_sessions import SQLiteSessions
+from benchmarks.stub_api import StubRoleAPI
+from benchmarks.synthetic import generate_configs, generate_players, generate_sessions
+from database.local_store import LocalStore
+from role_manager.outbox import Outbox
+from utils.api import RoleOperation
+
+@pytest.fixture
+def stub():
+    stub = StubRoleAPI().start()
+    yield stub
+    stub.stop()
+
+@pytest.fixture
+def environment(tmp_path, stub, monkeypatch):
+    for name, value in {
+        'API_URL': stub.url,
+        'TIMERS_DB_PATH': str(tmp_path / 'timers.db'),
+        'LOG_FILE': str(tmp_path / 'app.log'),
+        'USE_DB_CLONE': False,
+        'METRICS_PORT': 0,
+        'DRY_RUN': False,
+    }.items():
+        monkeypatch.setattr(config, name, value)
+    # Each run opens its own store, which shutdown() closes
+    monkeypatch.setattr(local_store, '_local_store', None)
+
+    client = mongomock.MongoClient()
+    database = client[config.DATABASE_NAME]
+    database[config.COLLECTION_NAME].insert_many(generate_players(50, 'whitelist', 'seed', 'activity'))
+    database['configs'].insert_many(generate_configs())
+    monkeypatch.setattr(mongodb, 'MongoClient', lambda *_, **__: client)
+
+    sessions = SQLiteSessions()
+    sessions.load(generate_sessions(50, config.HOURS_PLAYED_WEEKS))
+
+    @contextmanager
+    def sql_connection():
+        yield sessions
+
+    monkeypatch.setattr(main, 'sql_connection', sql_connection)
+    monkeypatch.setattr(main, 'install_signal_handlers', lambda: None)
+    # Stop after the first cycle
+    monkeypatch.setattr(main, 'wait_for_next_cycle', lambda delay: main.shutdown_event.set())
+    yield
+    main.shutdown_event.clear()
+
+def pending_operations():
+    store = LocalStore(config.TIMERS_DB_PATH)
+    try:
+        return store.query("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")[0][0]
+    finally:
+        store.close()
+
+def test_dry_run_makes_no_api_calls(environment, stub):
+    # Left pending by an earlier run
+    store = LocalStore(config.TIMERS_DB_PATH)
+    store.initialize()
+    Outbox(store, None).enqueue([RoleOperation('add', 'test-guild', 'earlier', 'seed', None)])
+    store.close()
+
+    main.cli(['run', '--dry-run'])
+
+    assert main.shutdown_event.is_set()
+    assert stub.calls == {}
+    assert pending_operations() == 1
+
+def test_run_resumes_the_outbox_and_sends_the_plan(environment, stub):
+    store = LocalStore(config.TIMERS_DB_PATH)
+    store.initialize()
+    Outbox(store, None).enqueue([RoleOperation('add', 'test-guild', 'earlier', 'seed', None)])
+    store.close()
+
+    main.cli(['run'])
+
+    assert stub.calls['/add-role'] > 1
+    assert pending_operations() == 0
+
+def test_failed_member_fetch_skips_hours_and_rules(environment, stub, monkeypatch):
+    def find(*_, **__):
+        raise mongodb.mongo_errors.PyMongoError('connection reset')
+
+    collection = mongodb.MongoClient()[config.DATABASE_NAME][config.COLLECTION_NAME]
+    monkeypatch.setattr(collection, 'find', find)
+    monkeypatch.setattr(main, 'fetch_hours_played', lambda columns: pytest.fail('hours tracked without members'))
+
+    main.cli(['run'])
+
+    assert stub.calls == {}
+    assert pending_operations() == 0
+
+def test_sharded_workers_refuse_to_refresh_a_clone(environment, monkeypatch):
+    monkeypatch.setattr(config, 'SHARD_COUNT', 2)
+    monkeypatch.setattr(config, 'USE_DB_CLONE', True)
+    with pytest.raises(ValueError, match='USE_DB_CLONE'):
+        main.initialize()
+
+@pytest.fixture
+def expiry(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'TIMERS_DB_PATH', str(tmp_path / 'timers.db'))
+    monkeypatch.setattr(config, 'DRY_RUN', False)
+    monkeypatch.setattr(local_store, '_local_store', None)
+    local_store.get_local_store().initialize()
+    role_manager = RoleManager('test-guild')
+    monkeypatch.setattr(role_manager.outbox, 'drain', lambda stop_event=None: (0, 0))
+    monkeypatch.setattr(main, 'role_manager', role_manager)
+    monkeypatch.setattr(main, 'rule_engine', RuleEngine(load_rules(), role_manager.timers))
+    monkeypatch.setattr(main, 'last_snapshot', {'columns': None, 'sources': None})
+    role_manager.start_timer('a', 'seed', -60)
+    yield role_manager
+    role_manager.store.close()
+
+def snapshot(seeding_points, roles=('whitelist', 'seed'), reward_points=100):
+    columns = MemberColumns(main.rule_engine.role_ids)
+    columns.update(to_member({'discord_user_id': 'a', 'discord_roles_ids': list(roles), 'seeding_points': seeding_points}))
+    main.last_snapshot.update(columns=columns, sources={'reward_points': reward_points, 'hours_played': None})
+
+def queued(role_manager):
+    return role_manager.store.query('SELECT action, user_id, lane FROM outbox')
+
+def test_expired_timer_removes_the_role_of_a_member_below_threshold(expiry):
+    snapshot(50)
+    main.handle_expired_timers()
+    assert queued(expiry) == [('remove', 'a', 'expire')]
+    assert expiry.timers == {}
+
+def test_expired_timer_of_a_member_who_qualifies_again_is_cancelled(expiry):
+    snapshot(150)
+    main.handle_expired_timers()
+    assert queued(expiry) == []
+    assert expiry.timers == {}
+
+def test_expired_timer_of_a_member_without_the_role_is_cancelled(expiry):
+    snapshot(50, roles=('whitelist',))
+    main.handle_expired_timers()
+    assert queued(expiry) == []
+    assert expiry.timers == {}
+
+def test_expired_timer_without_a_snapshot_is_left_to_the_next_cycle(expiry):
+    main.handle_expired_timers()
+    assert queued(expiry) == []
+    assert ('a', 'seed') in expiry.timers
+
+def test_expired_timer_without_reward_points_is_left_to_the_next_cycle(expiry):
+    snapshot(50, reward_points=None)
+    main.handle_expired_timers()
+    assert queued(expiry) == []
+    assert ('a', 'seed') in expiry.timers
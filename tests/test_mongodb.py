@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta
+import mongomock
+import numpy as np
+import pytest
+import config
+from database.mongodb import IncrementalSync, MemberColumns, to_member
+from role_manager.role_manager import Timer
+from benchmarks.synthetic import generate_configs
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+def player(user_id, updated_at, seeding_points=0):
+    return {
+        'discord_user_id': user_id,
+        'discord_roles_ids': ['whitelist'],
+        'seeding_points': seeding_points,
+        'updatedAt': updated_at,
+    }
+
+@pytest.fixture
+def database():
+    return mongomock.MongoClient()[config.DATABASE_NAME]
+
+@pytest.fixture
+def sync():
+    sync = IncrementalSync(full_resync_cycles=10)
+    # mongomock has no change streams
+    sync.use_change_stream = False
+    return sync
+
+def test_updated_since_reads_writes_that_committed_late(database, sync):
+    players = database[config.COLLECTION_NAME]
+    players.insert_one(player('a', NOW))
+    sync.sync(database)
+
+    # Written before the watermark, but committed after the last cycle read it
+    players.insert_one(player('b', NOW - timedelta(seconds=10)))
+    members, _ = sync.sync(database)
+    assert {member.discord_user_id for member in members} == {'a', 'b'}
+    assert sync.watermark == NOW
+
+def test_updated_since_rereads_writes_at_the_watermark(database, sync):
+    players = database[config.COLLECTION_NAME]
+    players.insert_one(player('a', NOW))
+    sync.sync(database)
+
+    players.update_one({'discord_user_id': 'a'}, {'$set': {'seeding_points': 50}})
+    members, _ = sync.sync(database)
+    assert [member.seeding_points for member in members] == [50]
+
+@pytest.fixture
+def config_reads(database, monkeypatch):
+    reads = []
+    configs = database['configs']
+    find_one = configs.find_one
+
+    def counted(*args, **kwargs):
+        reads.append(args)
+        return find_one(*args, **kwargs)
+
+    monkeypatch.setattr(configs, 'find_one', counted)
+    return reads
+
+def test_reward_points_are_cached_while_the_config_is_unchanged(database, sync, config_reads):
+    database['configs'].insert_many(generate_configs(120))
+    sync.cycles_since_resync = 1
+    assert sync.fetch_reward_points(database) == 120
+    assert sync.fetch_reward_points(database) == 120
+    # A version check and a full read, then only the version check
+    assert len(config_reads) == 3
+
+def test_config_without_update_time_is_read_once_per_cycle(database, sync, config_reads):
+    config_doc = generate_configs(120)[0]
+    del config_doc['updatedAt']
+    database['configs'].insert_one(config_doc)
+
+    sync.cycles_since_resync = 0
+    assert sync.fetch_reward_points(database) == 120
+    config_reads.clear()
+    sync.cycles_since_resync = 1
+    assert sync.fetch_reward_points(database) == 120
+    assert len(config_reads) == 1
+
+def member(user_id, roles=(), seeding_points=0, steamid64=None):
+    return to_member({
+        'discord_user_id': user_id,
+        'discord_roles_ids': ['whitelist', *roles],
+        'seeding_points': seeding_points,
+        'steamid64': steamid64,
+    })
+
+def test_discarded_slots_are_reused():
+    columns = MemberColumns(('seed',))
+    for user_id in 'abc':
+        columns.update(member(user_id, seeding_points=10))
+    columns.discard('b')
+    assert len(columns) == 2
+    assert columns.live.tolist() == [True, False, True]
+    assert columns.seeding_points.tolist() == [10, 0, 10]
+
+    columns.update(member('d', seeding_points=20))
+    assert columns.positions['d'] == 1
+    assert columns.size == 3
+    assert columns.user_ids == ['a', 'd', 'c']
+    assert columns.seeding_points.tolist() == [10, 20, 10]
+    assert columns.get('b') is None
+
+def test_retain_frees_the_slots_of_members_who_left():
+    columns = MemberColumns(('seed',))
+    for user_id in 'abc':
+        columns.update(member(user_id, roles=('seed',), steamid64=user_id))
+    columns.retain({'b'})
+    assert set(columns.positions) == {'b'}
+    assert sorted(columns.free) == [0, 2]
+    assert columns.live.tolist() == [False, True, False]
+    assert columns.has_role('seed').tolist() == [False, True, False]
+    assert columns.has_steam_id.tolist() == [False, True, False]
+    assert columns.steam_ids == [None, 'b', None]
+
+    columns.update(member('e'))
+    columns.update(member('f'))
+    assert columns.size == 3
+    assert sorted(columns.positions.values()) == [0, 1, 2]
+
+def test_role_bitmap_follows_updates():
+    columns = MemberColumns(('seed', 'activity'))
+    columns.update(member('a', roles=('seed', 'other')))
+    assert columns.roles.tolist() == [0b01]
+
+    columns.update(member('a', roles=('seed', 'activity')))
+    assert columns.has_role('seed').tolist() == [True]
+    assert columns.has_role('activity').tolist() == [True]
+
+    columns.update(member('a', roles=('activity',)))
+    assert columns.has_role('seed').tolist() == [False]
+    assert columns.has_role('activity').tolist() == [True]
+    assert columns.get('a').discord_roles_ids == frozenset({'whitelist', 'activity'})
+
+def test_timer_expirations_are_placed_by_slot():
+    columns = MemberColumns(('seed',))
+    for user_id in 'abc':
+        columns.update(member(user_id))
+    timers = {
+        ('a', 'seed'): Timer('seed', 100, ''),
+        ('c', 'seed'): Timer('seed', 300, ''),
+        ('c', 'activity'): Timer('activity', 400, ''),
+        ('gone', 'seed'): Timer('seed', 500, ''),
+    }
+    expirations = columns.timer_expirations(timers, 'seed')
+    assert expirations[[0, 2]].tolist() == [100, 300]
+    assert np.isnan(expirations[1])
@@ -0,0 +1,116 @@
+import pytest
+import config
+from database.local_store import LocalStore
+from role_manager.outbox import Outbox
+from utils.api import RoleOperation, RoleResult
+
+class FakeClient:
+    """
+    Confirms every operation except those of users in failing, and records the batches.
+    """
+    def __init__(self):
+        self.failing = set()
+        self.batches = []
+
+    def submit_batch(self, operations):
+        self.batches.append(operations)
+        return [
+            RoleResult(op, op.user_id not in self.failing, 500 if op.user_id in self.failing else 200, None)
+            for op in operations
+        ]
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalStore(str(tmp_path / 'timers.db'))
+    store.initialize()
+    yield store
+    store.close()
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+@pytest.fixture
+def outbox(store, client):
+    return Outbox(store, client)
+
+def add(user_id, role_id='seed'):
+    return RoleOperation('add', 'guild', user_id, role_id, None)
+
+def remove(user_id, role_id='seed', timestamp=None):
+    return RoleOperation('remove', 'guild', user_id, role_id, timestamp)
+
+def statuses(store):
+    return store.query('SELECT user_id, action, status, attempts FROM outbox ORDER BY id')
+
+def test_drain_confirms_operations(store, outbox, client):
+    outbox.enqueue([add('a'), remove('b')])
+    assert outbox.drain() == (2, 0)
+    assert statuses(store) == [('a', 'add', 'done', 1), ('b', 'remove', 'done', 1)]
+    assert outbox.pending_count() == 0
+
+def test_failed_operations_back_off_and_are_retried(store, outbox, client):
+    client.failing.add('a')
+    outbox.enqueue([add('a')])
+    assert outbox.drain() == (0, 1)
+    # Not due again until the backoff has passed
+    assert outbox.drain() == (0, 0)
+    assert statuses(store) == [('a', 'add', 'pending', 1)]
+
+    client.failing.clear()
+    store.execute('UPDATE outbox SET next_attempt_at = 0')
+    assert outbox.drain() == (1, 0)
+    assert statuses(store) == [('a', 'add', 'done', 2)]
+
+def test_failed_operations_are_tried_once_per_drain(store, outbox, client, monkeypatch):
+    # Due again before the batch ends, as with a hanging API
+    monkeypatch.setattr(config, 'OUTBOX_BACKOFF_BASE', 0)
+    client.failing.add('a')
+    outbox.enqueue([add('a'), add('b')])
+    assert outbox.drain() == (1, 1)
+    assert statuses(store) == [('a', 'add', 'pending', 1), ('b', 'add', 'done', 1)]
+    assert len(client.batches) == 1
+
+def test_operations_out_of_attempts_are_failed(store, outbox, client, monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_MAX_ATTEMPTS', 2)
+    client.failing.add('a')
+    outbox.enqueue([add('a')])
+    for _ in range(3):
+        outbox.drain()
+        store.execute('UPDATE outbox SET next_attempt_at = 0')
+    assert statuses(store) == [('a', 'add', 'failed', 2)]
+    assert len(client.batches) == 2
+
+def test_opposite_operation_supersedes_a_pending_one(store, outbox, client):
+    outbox.enqueue([add('a'), add('b')])
+    outbox.enqueue([remove('a')])
+    assert statuses(store) == [('a', 'add', 'superseded', 0), ('b', 'add', 'pending', 0), ('a', 'remove', 'pending', 0)]
+    outbox.drain()
+    assert [op.action for batch in client.batches for op in batch if op.user_id == 'a'] == ['remove']
+
+def test_identical_pending_operation_is_kept_once(store, outbox, client):
+    client.failing.add('a')
+    outbox.enqueue([add('a')])
+    outbox.drain()
+    outbox.enqueue([add('a')])
+    # The retry keeps its attempts and backoff
+    assert statuses(store) == [('a', 'add', 'pending', 1)]
+
+def test_full_lane_defers_operations(store, outbox, monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_LANE_DEPTH', {'grant': 2, 'expire': 1, 'correct': 1})
+    deferred = outbox.enqueue([add('a'), add('b'), add('c'), remove('d', timestamp='t'), remove('e')])
+    assert deferred == [add('c')]
+    assert outbox.pending_by_lane() == {'grant': 2, 'expire': 1, 'correct': 1}
+    assert outbox.enqueue([remove('f', timestamp='t')]) == [remove('f', timestamp='t')]
+
+def test_batches_take_lanes_by_weight(outbox, client, monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_BATCH_SIZE', 6)
+    monkeypatch.setattr(config, 'OUTBOX_LANE_WEIGHTS', {'grant': 2, 'expire': 1, 'correct': 1})
+    outbox.enqueue(
+        [remove(f'c{i}') for i in range(3)] +
+        [remove(f'e{i}', timestamp='t') for i in range(3)] +
+        [add(f'g{i}') for i in range(6)]
+    )
+    outbox.drain()
+    first = [op.user_id for op in client.batches[0]]
+    assert first == ['g0', 'g1', 'e0', 'c0', 'g2', 'g3']
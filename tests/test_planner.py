@@ -0,0 +1,53 @@
+from role_manager.planner import RolePlan
+from role_manager.role_manager import Timer
+from utils.api import RoleOperation
+
+def test_repeated_requests_collapse_into_one_operation():
+    plan = RolePlan({})
+    plan.add_role('a', 'seed')
+    plan.add_role('a', 'seed')
+    plan.add_role('a', 'activity')
+    assert plan.operations() == [
+        RoleOperation('add', 'test-guild', 'a', 'seed', None),
+        RoleOperation('add', 'test-guild', 'a', 'activity', None),
+    ]
+    assert plan.summary()['api_calls_saved'] == 1
+
+def test_last_request_for_a_role_wins():
+    plan = RolePlan({})
+    plan.add_role('a', 'seed')
+    plan.remove_role('a', 'seed')
+    assert plan.operations() == [RoleOperation('remove', 'test-guild', 'a', 'seed', None)]
+
+def test_adding_a_role_back_cancels_only_its_timer():
+    timers = {('a', 'seed'): Timer('seed', 100, '2024-01-01T00:00:00'), ('a', 'other'): Timer('other', 100, '')}
+    plan = RolePlan(timers)
+    plan.add_role('a', 'seed')
+    assert plan.timer_changes == {('a', 'seed'): ('cancel', None)}
+
+def test_cancelling_a_timer_that_does_not_exist_is_dropped():
+    plan = RolePlan({})
+    plan.add_role('a', 'seed')
+    plan.cancel_timer('b', 'seed')
+    assert plan.timer_changes == {}
+    assert plan.summary()['db_writes_saved'] == 2
+
+def test_start_then_add_in_the_same_cycle_writes_no_timer():
+    plan = RolePlan({})
+    plan.start_timer('a', 'seed', 60)
+    assert plan.timer_changes == {('a', 'seed'): ('start', 60)}
+    plan.add_role('a', 'seed')
+    assert plan.timer_changes == {}
+
+def test_removal_with_timer_sends_the_timer_start():
+    timers = {('a', 'seed'): Timer('seed', 100, '2024-01-01T00:00:00')}
+    plan = RolePlan(timers)
+    plan.remove_role('a', 'seed', remove_timer=True)
+    plan.remove_role('b', 'seed', remove_timer=True)
+    assert plan.operations() == [
+        RoleOperation('remove', 'test-guild', 'a', 'seed', '2024-01-01T00:00:00'),
+        RoleOperation('remove', 'test-guild', 'b', 'seed', 'No timer found'),
+    ]
+    assert plan.timer_changes == {('a', 'seed'): ('cancel', None)}
+    summary = plan.summary()
+    assert (summary['role_removes'], summary['timer_cancels'], summary['api_calls_saved']) == (2, 1, 2)
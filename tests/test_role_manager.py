@@ -0,0 +1,138 @@
+import time
+import pytest
+import config
+import database.local_store as local_store
+from role_manager import RoleManager, RolePlan
+
+@pytest.fixture
+def role_manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'TIMERS_DB_PATH', str(tmp_path / 'timers.db'))
+    monkeypatch.setattr(local_store, '_local_store', None)
+    local_store.get_local_store().initialize()
+    role_manager = RoleManager('test-guild')
+    yield role_manager
+    role_manager.store.close()
+
+def execute(role_manager, plan):
+    with role_manager.store.transaction():
+        return role_manager.execute_plan(plan)
+
+def stored_timers(role_manager):
+    return role_manager.store.query('SELECT discord_user_id, role_id FROM timers')
+
+def test_deferred_expiry_keeps_its_timer(role_manager, monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_LANE_DEPTH', {'grant': 10, 'expire': 0, 'correct': 10})
+    role_manager.start_timer('a', 'seed', -60)
+
+    plan = RolePlan(role_manager.timers)
+    plan.remove_role('a', 'seed', remove_timer=True)
+    assert execute(role_manager, plan) == 0
+    assert ('a', 'seed') in role_manager.timers
+    assert stored_timers(role_manager) == [('a', 'seed')]
+
+    # The next cycle still sees the expired timer and plans the removal again
+    monkeypatch.setattr(config, 'OUTBOX_LANE_DEPTH', {'grant': 10, 'expire': 10, 'correct': 10})
+    timer = role_manager.timers[('a', 'seed')]
+    assert timer.expiration < time.time()
+    plan = RolePlan(role_manager.timers)
+    plan.remove_role('a', 'seed', remove_timer=True)
+    assert execute(role_manager, plan) == 1
+    assert role_manager.timers == {}
+    assert stored_timers(role_manager) == []
+    assert role_manager.outbox.pending_by_lane()['expire'] == 1
+
+def test_timers_of_accepted_operations_are_applied(role_manager):
+    role_manager.start_timer('a', 'seed', 60)
+    plan = RolePlan(role_manager.timers)
+    plan.add_role('a', 'seed')
+    plan.start_timer('b', 'seed', 60)
+    assert execute(role_manager, plan) == 1
+    assert set(role_manager.timers) == {('b', 'seed')}
+
+def cycle_plan(role_manager, seen_at=None):
+    # The plan of a full cycle that evaluated the seed rule
+    plan = RolePlan(role_manager.timers, seen_at)
+    plan.evaluated_roles.add('seed')
+    return plan
+
+def test_no_grace_timer_while_a_removal_is_pending(role_manager):
+    role_manager.start_timer('a', 'seed', -60)
+    plan = RolePlan(role_manager.timers)
+    plan.remove_role('a', 'seed', remove_timer=True)
+    execute(role_manager, plan)
+    assert role_manager.timers == {}
+
+    # MongoDB still shows the role, so the next cycle would start a new grace timer
+    plan = cycle_plan(role_manager)
+    plan.start_timer('a', 'seed', 60)
+    role_manager.pending_operations.reconcile(plan)
+    execute(role_manager, plan)
+    assert role_manager.timers == {}
+    assert role_manager.pending_operations.held_back == 1
+
+    # Once MongoDB shows the removal, the removal is forgotten
+    role_manager.pending_operations.reconcile(cycle_plan(role_manager))
+    assert not role_manager.pending_operations.removing('a', 'seed')
+
+def plan_remove(role_manager, seen_at):
+    plan = cycle_plan(role_manager, seen_at)
+    plan.remove_role('a', 'seed')
+    return plan
+
+def test_first_sighting_is_kept_across_deferral_and_supersede(role_manager, monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_LANE_DEPTH', {'grant': 10, 'expire': 10, 'correct': 0})
+    execute(role_manager, plan_remove(role_manager, 100))
+    monkeypatch.setattr(config, 'OUTBOX_LANE_DEPTH', {'grant': 10, 'expire': 10, 'correct': 10})
+    execute(role_manager, plan_remove(role_manager, 200))
+
+    plan = cycle_plan(role_manager, 300)
+    plan.add_role('a', 'seed')
+    role_manager.pending_operations.reconcile(plan)
+    execute(role_manager, plan)
+    plan = plan_remove(role_manager, 400)
+    role_manager.pending_operations.reconcile(plan)
+    execute(role_manager, plan)
+
+    assert role_manager.store.query('SELECT action, status, seen_at FROM outbox ORDER BY id') == [
+        ('remove', 'superseded', 100),
+        ('add', 'superseded', 300),
+        ('remove', 'pending', 100),
+    ]
+
+    # Once MongoDB shows the change, the next one is timed from its own sighting
+    role_manager.pending_operations.reconcile(cycle_plan(role_manager))
+    assert role_manager.pending_operations.first_seen == {}
+
+def test_cycles_that_skip_a_rule_forget_nothing_of_its_role(role_manager):
+    execute(role_manager, plan_remove(role_manager, 100))
+
+    # A failed fetch or a skipped seed rule plans nothing for the role
+    role_manager.pending_operations.reconcile(RolePlan(role_manager.timers))
+    assert role_manager.pending_operations.removing('a', 'seed')
+    assert role_manager.pending_operations.first_seen == {('a', 'seed', 'remove'): 100}
+
+    plan = plan_remove(role_manager, 200)
+    role_manager.pending_operations.reconcile(plan)
+    execute(role_manager, plan)
+    assert role_manager.pending_operations.held_back == 1
+
+def test_next_expiration_skips_cancelled_and_restarted_timers(role_manager):
+    role_manager.start_timer('a', 'seed', 100)
+    role_manager.start_timer('b', 'seed', 200)
+    role_manager.cancel_timer('a', 'seed')
+    assert role_manager.next_expiration() == role_manager.timers[('b', 'seed')].expiration
+
+    role_manager.start_timer('b', 'seed', 300)
+    assert role_manager.next_expiration() == role_manager.timers[('b', 'seed')].expiration
+    role_manager.cancel_timer('b', 'seed')
+    assert role_manager.next_expiration() is None
+
+def test_pop_expired_returns_live_timers_once(role_manager):
+    role_manager.start_timer('a', 'seed', -60)
+    role_manager.start_timer('b', 'seed', -30)
+    role_manager.start_timer('c', 'seed', 60)
+    role_manager.cancel_timer('b', 'seed')
+    assert role_manager.pop_expired(time.time()) == [('a', 'seed')]
+    # The timer stays until it is cancelled
+    assert ('a', 'seed') in role_manager.timers
+    assert role_manager.pop_expired(time.time()) == []
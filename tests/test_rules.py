@@ -0,0 +1,125 @@
+import time
+import pytest
+import config
+from database.mongodb import MemberColumns, to_member
+from role_manager import RuleEngine, load_rules
+from role_manager.planner import RolePlan
+from role_manager.role_manager import Timer
+
+def columns_of(engine, *docs):
+    columns = MemberColumns(engine.role_ids)
+    for user_id, roles, seeding_points, steamid64 in docs:
+        columns.update(to_member({
+            'discord_user_id': user_id,
+            'discord_roles_ids': ['whitelist', *roles],
+            'seeding_points': seeding_points,
+            'steamid64': steamid64,
+        }))
+    return columns
+
+def evaluate(engine, columns, reward_points=100, hours_played=None):
+    plan = RolePlan(engine.timers)
+    sources = {'reward_points': reward_points, 'hours_played': hours_played}
+    return engine.evaluate(columns, sources, plan), plan
+
+def actions(plan):
+    return {key: op.action for key, op in plan.role_changes.items()}
+
+def test_default_rules(monkeypatch):
+    monkeypatch.setattr(config, 'ROLE_RULES', '')
+    rules = load_rules()
+    assert [(rule.name, rule.role_id, rule.metric, rule.threshold, rule.inclusive) for rule in rules] == [
+        ('seed', 'seed', 'seeding_points', None, False),
+        ('activity', 'activity', 'hours_played', 25, True),
+    ]
+    assert rules[0].grace_seconds == config.TIMER_DURATION
+    assert rules[1].grace_seconds == 0
+
+def test_rules_from_config(monkeypatch):
+    monkeypatch.setattr(config, 'ROLE_RULES', '[{"name": "veteran", "role_id": 42, "metric": "hours_played", "threshold": 100}]')
+    assert [tuple(rule) for rule in load_rules()] == [('veteran', '42', 'hours_played', 100, False, 0)]
+
+@pytest.mark.parametrize('rules, message', [
+    ('[{"role_id": "a", "metric": "kills", "threshold": 1}]', 'unknown metric'),
+    ('[{"role_id": "a", "metric": "hours_played"}]', 'needs a threshold'),
+    ('[{"name": "one", "role_id": "a", "metric": "seeding_points"},'
+     ' {"name": "two", "role_id": "a", "metric": "hours_played", "threshold": 5}]', 'both manage role a'),
+])
+def test_invalid_rules_are_rejected(monkeypatch, rules, message):
+    monkeypatch.setattr(config, 'ROLE_RULES', rules)
+    with pytest.raises(ValueError, match=message):
+        load_rules()
+
+@pytest.fixture
+def seed_engine(monkeypatch):
+    monkeypatch.setattr(config, 'ROLE_RULES', '')
+    monkeypatch.setattr(config, 'ACTIVITY_ROLE_ID', None)
+    return RuleEngine(load_rules(), {})
+
+def test_seed_rule_needs_more_than_the_reward_points(seed_engine):
+    columns = columns_of(seed_engine, ('a', (), 100, None), ('b', (), 101, None))
+    outcomes, plan = evaluate(seed_engine, columns)
+    assert actions(plan) == {('b', 'seed'): 'add'}
+    assert outcomes['seed']['assigned'] == ['b']
+    assert plan.evaluated_roles == {'seed'}
+
+def test_seed_role_is_removed_once_its_grace_timer_expires(seed_engine):
+    columns = columns_of(seed_engine, ('a', ('seed',), 100, None))
+    outcomes, plan = evaluate(seed_engine, columns)
+    assert actions(plan) == {}
+    assert plan.timer_changes == {('a', 'seed'): ('start', config.TIMER_DURATION)}
+    assert outcomes['seed']['timed'] == ['a']
+
+    # A running timer is left alone
+    seed_engine.timers[('a', 'seed')] = Timer('seed', time.time() + 60, '2026-01-01T00:00:00')
+    outcomes, plan = evaluate(seed_engine, columns)
+    assert actions(plan) == {}
+    assert plan.timer_changes == {}
+    assert outcomes['seed']['timed'] == ['a']
+
+    seed_engine.timers[('a', 'seed')] = Timer('seed', time.time() - 60, '2026-01-01T00:00:00')
+    outcomes, plan = evaluate(seed_engine, columns)
+    assert plan.operations()[0].timestamp == '2026-01-01T00:00:00'
+    assert actions(plan) == {('a', 'seed'): 'remove'}
+    assert plan.timer_changes == {('a', 'seed'): ('cancel', None)}
+    assert outcomes['seed']['removed'] == ['a']
+
+def test_seed_rule_is_skipped_without_reward_points(seed_engine):
+    columns = columns_of(seed_engine, ('a', ('seed',), 0, None))
+    outcomes, plan = evaluate(seed_engine, columns, reward_points=None)
+    assert outcomes == {}
+    assert actions(plan) == {}
+    assert plan.evaluated_roles == set()
+
+@pytest.fixture
+def activity_engine(monkeypatch):
+    monkeypatch.setattr(config, 'ROLE_RULES', '')
+    monkeypatch.setattr(config, 'SEED_ROLE_ID', None)
+    return RuleEngine(load_rules(), {})
+
+def test_activity_rule_includes_the_threshold(activity_engine):
+    columns = columns_of(activity_engine, ('a', (), 0, '1'), ('b', (), 0, '2'), ('c', ('activity',), 0, '3'))
+    outcomes, plan = evaluate(activity_engine, columns, hours_played={'1': 25, '2': 24.9})
+    # No grace timer: the role goes as soon as the hours drop
+    assert actions(plan) == {('a', 'activity'): 'add', ('c', 'activity'): 'remove'}
+    assert plan.timer_changes == {}
+    assert outcomes['activity']['unchanged'] == 1
+
+def test_activity_rule_skips_members_without_a_steam_id(activity_engine):
+    columns = columns_of(activity_engine, ('a', ('activity',), 0, None), ('b', (), 0, None))
+    outcomes, plan = evaluate(activity_engine, columns, hours_played={'1': 100})
+    assert actions(plan) == {}
+    assert outcomes['activity']['unchanged'] == 0
+
+def test_activity_rule_is_skipped_without_hours(activity_engine):
+    columns = columns_of(activity_engine, ('a', ('activity',), 0, '1'))
+    outcomes, plan = evaluate(activity_engine, columns, hours_played=None)
+    assert outcomes == {}
+    assert actions(plan) == {}
+
+def test_qualifies_matches_evaluate(seed_engine):
+    rule = seed_engine.rules[0]
+    member = to_member({'discord_user_id': 'a', 'discord_roles_ids': ['whitelist'], 'seeding_points': 100})
+    assert seed_engine.qualifies(rule, member, {'reward_points': 100}) is False
+    assert seed_engine.qualifies(rule, member, {'reward_points': 99}) is True
+    assert seed_engine.qualifies(rule, member, {'reward_points': None}) is None
@@ -0,0 +1,59 @@
+import threading
+import time
+import pytest
+from utils.sharding import ShardLease, shard_of, shard_path
+
+@pytest.fixture
+def lease_path(tmp_path):
+    return str(tmp_path / 'shards.db')
+
+def test_shard_of_is_stable_and_in_range():
+    shards = [shard_of(user_id, 4) for user_id in range(1000)]
+    assert shards == [shard_of(str(user_id), 4) for user_id in range(1000)]
+    assert set(shards) == {0, 1, 2, 3}
+
+def test_shard_path():
+    assert shard_path('data/timers.db', 2) == 'data/timers.shard2.db'
+
+def test_workers_lease_different_shards_and_standbys_wait(lease_path):
+    first = ShardLease(lease_path, 2, 60, owner='first')
+    second = ShardLease(lease_path, 2, 60, owner='second')
+    standby = ShardLease(lease_path, 2, 60, owner='standby')
+    assert {first.try_acquire(), second.try_acquire()} == {0, 1}
+    assert standby.try_acquire() is None
+    assert first.renew()
+    assert first.active_shards() == 2
+
+def test_restarted_worker_gets_its_own_shard_back(lease_path):
+    first = ShardLease(lease_path, 2, 60, owner='first')
+    shard = first.try_acquire()
+    ShardLease(lease_path, 2, 60, owner='second').try_acquire()
+    assert ShardLease(lease_path, 2, 60, owner='first').try_acquire() == shard
+
+def test_expired_lease_is_taken_over(lease_path):
+    owner = ShardLease(lease_path, 1, 0.2, owner='owner')
+    standby = ShardLease(lease_path, 1, 0.2, owner='standby')
+    assert owner.try_acquire() == 0
+    assert standby.try_acquire() is None
+
+    time.sleep(0.3)
+    assert standby.try_acquire() == 0
+    # The old owner can't renew a shard it lost
+    assert not owner.renew()
+    assert standby.renew()
+
+def test_keep_alive_stops_a_worker_that_lost_its_shard(lease_path):
+    owner = ShardLease(lease_path, 1, 0.3, owner='owner')
+    owner.try_acquire()
+    stop_event = threading.Event()
+    # Another worker took the shard while the owner was stalled
+    owner.conn.execute("UPDATE shard_leases SET owner = 'standby'")
+    thread = owner.keep_alive(stop_event)
+    thread.join(timeout=2)
+    assert stop_event.is_set()
+
+def test_release_frees_the_shard(lease_path):
+    owner = ShardLease(lease_path, 1, 60, owner='owner')
+    owner.try_acquire()
+    owner.release()
+    assert ShardLease(lease_path, 1, 60, owner='standby').try_acquire() == 0
@@ -1,2 +1,2 @@
-from .utils import execute_db_query, run_command, initialize_database, run_rsync
+from .utils import execute_db_query, run_command, initialize_database, run_rsync, clone_refresher
 from .api import get_api_client
\ No newline at end of file
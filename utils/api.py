@@ -1,14 +1,24 @@
 import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from ratelimiter import RateLimiter
 from threading import Lock
 import config
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+# A single role change; action is 'add' or 'remove', timestamp is only sent with removals
+RoleOperation = namedtuple('RoleOperation', ['action', 'guild_id', 'user_id', 'role_id', 'timestamp'])
+RoleResult = namedtuple('RoleResult', ['operation', 'ok', 'status', 'error'])
+
 class APIClient:
     """
     Abstract base class for API clients.
+    add_role and remove_role return True when the API confirmed the change.
     """
     def add_role(self, guild_id, user_id, role_id):
         raise NotImplementedError
@@ -16,6 +26,25 @@ class APIClient:
     def remove_role(self, guild_id, user_id, role_id, timestamp):
         raise NotImplementedError
 
+    def set_rate_limit(self, rate):
+        """
+        Changes the requests per second the client may send.
+        """
+        raise NotImplementedError
+
+    def submit_batch(self, operations):
+        """
+        Runs every RoleOperation and returns a RoleResult for each, in the same order.
+        """
+        results = []
+        for op in operations:
+            if op.action == 'add':
+                ok = self.add_role(op.guild_id, op.user_id, op.role_id)
+            else:
+                ok = self.remove_role(op.guild_id, op.user_id, op.role_id, op.timestamp)
+            results.append(RoleResult(op, bool(ok), None, None))
+        return results
+
 class CustomAPIClient(APIClient):
     """
     Concrete implementation of APIClient for the custom API.
@@ -25,6 +54,11 @@ class CustomAPIClient(APIClient):
         self.api_lock = Lock()
         self.limiter = RateLimiter(max_calls=rate_limit, period=period)  # e.g., 4 requests per second
 
+    def set_rate_limit(self, rate):
+        # Fractional rates become one call per 1/rate seconds
+        max_calls = max(1, int(rate))
+        self.limiter = RateLimiter(max_calls=max_calls, period=max_calls / rate)
+
     def add_role(self, guild_id, user_id, role_id):
         with self.api_lock:
             with self.limiter:
@@ -35,13 +69,16 @@ class CustomAPIClient(APIClient):
                     "roleId": role_id
                 }
                 try:
-                    response = requests.post(f"{self.api_url}/add-role", json=data)
+                    with metrics.timer('api_call'):
+                        response = requests.post(f"{self.api_url}/add-role", json=data)
                     if response.status_code == 200:
                         logger.debug(f"Role {role_id} added to user {user_id} via API call.")
-                    else:
-                        logger.error(f"Failed to add role to user {user_id}: {response.status_code} {response.text}")
+                        return True
+                    logger.error(f"Failed to add role to user {user_id}: {response.status_code} {response.text}")
                 except Exception as e:
                     logger.error(f"Error adding role to user {user_id}: {e}")
+                metrics.inc('api_errors_total')
+                return False
 
     def remove_role(self, guild_id, user_id, role_id, timestamp=None):
         with self.api_lock:
@@ -56,13 +93,138 @@ class CustomAPIClient(APIClient):
                     data["timestamp"] = timestamp
                     logger.debug(f"Including timestamp: {timestamp}")
                 try:
-                    response = requests.post(f"{self.api_url}/remove-role", json=data)
+                    with metrics.timer('api_call'):
+                        response = requests.post(f"{self.api_url}/remove-role", json=data)
                     if response.status_code == 200:
                         logger.debug(f"Role {role_id} removed from user {user_id} via API call.")
-                    else:
-                        logger.error(f"Failed to remove role from user {user_id}: {response.status_code} {response.text}")
+                        return True
+                    logger.error(f"Failed to remove role from user {user_id}: {response.status_code} {response.text}")
                 except Exception as e:
                     logger.error(f"Error removing role from user {user_id}: {e}")
+                metrics.inc('api_errors_total')
+                return False
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. The refill rate halves on every throttle() and climbs back
+    towards its ceiling on every recover(); a Retry-After pauses it entirely.
+    """
+    def __init__(self, rate, capacity, min_rate=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and returns the seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = max(self.updated, now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate + max(0.0, self.updated - now)
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            if retry_after:
+                # Refilling starts again only once the server's pause is over
+                self.updated = max(self.updated, time.monotonic() + retry_after)
+            logger.warning(f"Role API throttled, rate lowered to {self.rate:.2f}/s")
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def set_max_rate(self, rate):
+        with self.lock:
+            throttled = self.rate < self.max_rate
+            self.max_rate = rate
+            self.min_rate = min(self.min_rate, rate)
+            # A throttled bucket stays throttled, under the new ceiling
+            self.rate = min(self.rate, rate) if throttled else rate
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+class SessionAPIClient(APIClient):
+    """
+    APIClient that reuses keep-alive connections, allows max_in_flight concurrent requests and
+    paces them with an adaptive TokenBucket that backs off on 429 responses.
+    """
+    def __init__(self, api_url, rate_limit=4, max_in_flight=4, timeout=10, max_retries=3):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.bucket = TokenBucket(rate_limit, capacity=max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='role-api')
+
+    def execute(self, op):
+        """
+        Sends a single RoleOperation, retrying after 429 responses, and returns its RoleResult.
+        """
+        data = {
+            "guildId": op.guild_id,
+            "userId": op.user_id,
+            "roleId": op.role_id
+        }
+        if op.action == 'remove' and op.timestamp is not None:
+            data["timestamp"] = op.timestamp
+        path = 'add-role' if op.action == 'add' else 'remove-role'
+
+        for attempt in range(self.max_retries + 1):
+            metrics.inc('rate_limit_wait_seconds_total', self.bucket.acquire())
+            try:
+                with metrics.timer('api_call'):
+                    response = self.session.post(f"{self.api_url}/{path}", json=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.error(f"Error sending {op.action} role {op.role_id} for user {op.user_id}: {e}")
+                metrics.inc('api_errors_total')
+                return RoleResult(op, False, None, str(e))
+
+            if response.status_code == 429 and attempt < self.max_retries:
+                metrics.inc('rate_limit_throttles_total')
+                self.bucket.throttle(parse_retry_after(response.headers.get('Retry-After')))
+                continue
+            if response.status_code == 200:
+                self.bucket.recover()
+                logger.debug(f"Role {op.role_id} {op.action} for user {op.user_id} done via API call.")
+                return RoleResult(op, True, response.status_code, None)
+
+            logger.error(f"Failed to {op.action} role for user {op.user_id}: {response.status_code} {response.text}")
+            metrics.inc('api_errors_total')
+            return RoleResult(op, False, response.status_code, response.text)
+
+    def add_role(self, guild_id, user_id, role_id):
+        return self.execute(RoleOperation('add', guild_id, user_id, role_id, None)).ok
+
+    def remove_role(self, guild_id, user_id, role_id, timestamp=None):
+        return self.execute(RoleOperation('remove', guild_id, user_id, role_id, timestamp)).ok
+
+    def set_rate_limit(self, rate):
+        self.bucket.set_max_rate(rate)
+
+    def submit_batch(self, operations):
+        return list(self.executor.map(self.execute, operations))
 
 # Factory function to instantiate the appropriate API client
 def get_api_client():
@@ -70,4 +232,11 @@ def get_api_client():
     Factory function to return an instance of APIClient.
     Modify this function to return different API clients as needed.
     """
-    return CustomAPIClient(api_url=config.API_URL)
+    if config.API_CLIENT == 'custom':
+        return CustomAPIClient(api_url=config.API_URL, rate_limit=int(config.API_RATE_LIMIT))
+    return SessionAPIClient(
+        api_url=config.API_URL,
+        rate_limit=config.API_RATE_LIMIT,
+        max_in_flight=config.API_MAX_IN_FLIGHT,
+        timeout=config.API_TIMEOUT
+    )
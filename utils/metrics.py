@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'whitelister_'
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and phase timings, rendered in the
+    Prometheus text exposition format.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+        # Labels added to every series, such as the shard of a sharded worker
+        self.const_labels = {}
+
+    def _update(self, kind, name, labels, update, family=None):
+        key = (PREFIX + name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types[key[0]] = (PREFIX + (family or name), kind)
+            self.values[key] = update(self.values.get(key, 0))
+
+    def inc(self, name, amount=1, **labels):
+        self._update('counter', name, labels, lambda value: value + amount)
+
+    def set(self, name, value, **labels):
+        self._update('gauge', name, labels, lambda _: value)
+
+    def summary(self, name, value, **labels):
+        self._update('summary', f'{name}_sum', labels, lambda total: total + value, name)
+        self._update('summary', f'{name}_count', labels, lambda count: count + 1, name)
+
+    def observe(self, phase, seconds):
+        self.summary('phase_seconds', seconds, phase=phase)
+        self._update('gauge', 'phase_last_seconds', {'phase': phase}, lambda _: seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.monotonic() - started)
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+            types = dict(self.types)
+
+        lines = []
+        current = None
+        for (name, labels), value in items:
+            family, kind = types[name]
+            if family != current:
+                lines.append(f'# TYPE {family} {kind}')
+                current = family
+            label_text = ','.join(f'{key}="{val}"' for key, val in (*self.const_labels.items(), *labels))
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Writes the metrics for the node exporter textfile collector, replacing the file atomically.
+        """
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves the metrics over HTTP on a daemon thread.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return server
+
+metrics = Metrics()
@@ -0,0 +1,55 @@
+import cProfile
+import io
+import logging
+import pstats
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+class CycleProfiler:
+    """
+    Context manager that profiles the cycles run inside it, with cProfile ('cpu') or
+    tracemalloc ('memory'). CPU stats accumulate over cycles; memory stats compare the
+    allocations at the end of each cycle with its start. The sorted stats are rewritten
+    to path after every cycle. cProfile only sees the calling thread, so the MongoDB and
+    SQL fetches running on the cycle executor show up as waits on their futures.
+    """
+    def __init__(self, mode, path, limit=40):
+        self.mode = mode
+        self.path = path
+        self.limit = limit
+        self.profile = cProfile.Profile() if mode == 'cpu' else None
+        self.start_snapshot = None
+
+    def __enter__(self):
+        if self.profile:
+            self.profile.enable()
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+            self.start_snapshot = tracemalloc.take_snapshot()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile:
+            self.profile.disable()
+            report = io.StringIO()
+            pstats.Stats(self.profile, stream=report).sort_stats('cumulative').print_stats(self.limit)
+            text = report.getvalue()
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            lines = [f'Traced memory: {current / 1e6:.1f} MB current, {peak / 1e6:.1f} MB peak', '']
+            lines += [str(stat) for stat in snapshot.compare_to(self.start_snapshot, 'lineno')[:self.limit]]
+            lines += ['', 'Largest allocations held:']
+            lines += [str(stat) for stat in snapshot.statistics('lineno')[:self.limit]]
+            text = '\n'.join(lines) + '\n'
+            tracemalloc.reset_peak()
+
+        try:
+            with open(self.path, 'w') as f:
+                f.write(text)
+            logger.info(f'Wrote {self.mode} profile of the cycle to {self.path}')
+        except OSError as err:
+            logger.error(f'Failed to write profile to {self.path}: {err}')
+        return False
@@ -0,0 +1,51 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class AdaptiveScheduler:
+    """
+    Decides when the next cycle starts. Cycles run on a cadence measured from cycle start,
+    so a cycle's own duration doesn't push the schedule back. The interval stretches
+    towards ceiling while cycles change nothing, and shrinks towards floor when they do.
+    A cycle that outlasts its interval counts as an overrun, and the next one starts
+    right away.
+    """
+    def __init__(self, base, floor, ceiling, grow=1.5, shrink=0.5):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.interval = min(max(base, floor), ceiling)
+        self.grow = grow
+        self.shrink = shrink
+        self.started = None
+        self.last_duration = 0.0
+        self.overruns = 0
+
+    def cycle_started(self):
+        self.started = time.monotonic()
+
+    def cycle_finished(self, changes):
+        """
+        Records how many changes the cycle made and returns the seconds to wait before
+        the next one.
+        """
+        now = time.monotonic()
+        self.last_duration = now - self.started
+        interval = self.interval
+
+        if changes:
+            self.interval = max(self.floor, self.interval * self.shrink)
+        else:
+            self.interval = min(self.ceiling, self.interval * self.grow)
+
+        if self.last_duration > interval:
+            self.overruns += 1
+            logger.warning(
+                f'Cycle took {self.last_duration:.1f}s, overrunning its {interval:.1f}s interval '
+                f'({self.overruns} overruns so far).'
+            )
+            return 0.0
+
+        delay = self.started + self.interval - now
+        logger.info(f'Cycle made {changes} changes in {self.last_duration:.1f}s, next cycle in {max(0.0, delay):.0f}s.')
+        return max(0.0, delay)
@@ -0,0 +1,152 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LEASE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shard_leases (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT,
+    expires_at REAL
+)
+'''
+
+def shard_of(user_id, shard_count):
+    """
+    Stable shard of a Discord user, the same in every process and across restarts.
+    """
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+def shard_path(path, shard):
+    """
+    Per-shard variant of a file path: timers.db -> timers.shard2.db.
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{shard}{ext}'
+
+class ShardLease:
+    """
+    Leases one of shard_count shards from a SQLite file shared by every worker. A lease
+    lasts ttl seconds and is renewed in the background; workers without a free shard wait
+    as standbys and take over shards whose lease ran out. A worker that fails to renew
+    has lost its shard and must stop, so each shard has a single owner.
+    """
+    def __init__(self, path, shard_count, ttl, owner=None):
+        self.path = path
+        self.shard_count = shard_count
+        self.ttl = ttl
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.shard = None
+        self.renewed_at = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        # Rollback journal rather than WAL, which needs shared memory and breaks on network shares
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute(LEASE_SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def try_acquire(self):
+        """
+        Claims a shard that is unleased, expired or already ours. Returns it, or None
+        when every shard is held.
+        """
+        now = time.time()
+        with self._transaction():
+            leases = {
+                shard: (owner, expires_at)
+                for shard, owner, expires_at in self.conn.execute('SELECT shard, owner, expires_at FROM shard_leases')
+            }
+            free = [
+                shard for shard in range(self.shard_count)
+                if shard not in leases or leases[shard][1] <= now or leases[shard][0] == self.owner
+            ]
+            if not free:
+                return None
+            shard = next((shard for shard in free if leases.get(shard, (None,))[0] == self.owner), free[0])
+            self.conn.execute('REPLACE INTO shard_leases (shard, owner, expires_at) VALUES (?, ?, ?)',
+                              (shard, self.owner, now + self.ttl))
+        self.shard = shard
+        self.renewed_at = now
+        return shard
+
+    def acquire(self, stop_event):
+        """
+        Waits until a shard is free and claims it. Returns None if stop_event is set first.
+        """
+        while not stop_event.is_set():
+            shard = self.try_acquire()
+            if shard is not None:
+                logger.info(f'{self.owner} leased shard {shard} of {self.shard_count}.')
+                return shard
+            logger.info(f'All {self.shard_count} shards are leased, {self.owner} is standing by.')
+            stop_event.wait(self.ttl / 3)
+        return None
+
+    def renew(self):
+        """
+        Extends our lease. Returns False if another worker has taken the shard.
+        """
+        now = time.time()
+        with self._transaction():
+            cursor = self.conn.execute(
+                'UPDATE shard_leases SET expires_at = ? WHERE shard = ? AND owner = ?',
+                (now + self.ttl, self.shard, self.owner)
+            )
+            renewed = cursor.rowcount == 1
+        if renewed:
+            self.renewed_at = now
+        return renewed
+
+    def active_shards(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM shard_leases WHERE expires_at > ?', (time.time(),)).fetchone()[0]
+
+    def keep_alive(self, stop_event, on_active_shards=None):
+        """
+        Renews the lease every third of its ttl on a daemon thread, reporting the number of
+        active shards to on_active_shards. Sets stop_event when the lease is lost.
+        """
+        def renew_loop():
+            while not stop_event.wait(self.ttl / 3):
+                try:
+                    if not self.renew():
+                        logger.error(f'Lost the lease on shard {self.shard}, stopping.')
+                        stop_event.set()
+                        return
+                    if on_active_shards:
+                        on_active_shards(self.active_shards())
+                except sqlite3.Error as err:
+                    logger.error(f'Failed to renew the lease on shard {self.shard}: {err}')
+                    # Past expiry another worker may own the shard
+                    if time.time() - self.renewed_at >= self.ttl:
+                        logger.error(f'Lease on shard {self.shard} expired, stopping.')
+                        stop_event.set()
+                        return
+
+        if on_active_shards:
+            on_active_shards(self.active_shards())
+        thread = threading.Thread(target=renew_loop, name='shard-lease', daemon=True)
+        thread.start()
+        return thread
+
+    def release(self):
+        with self._transaction():
+            self.conn.execute('DELETE FROM shard_leases WHERE shard = ? AND owner = ?', (self.shard, self.owner))
+        self.conn.close()
+        logger.info(f'Released shard {self.shard}.')
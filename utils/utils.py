@@ -1,38 +1,24 @@
-import sqlite3
 import subprocess
 import logging
 import os
 import re
+import time
+from pymongo import MongoClient, errors as mongo_errors
 import config
+from database.local_store import get_local_store
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 def execute_db_query(query, args=()):
-    conn = sqlite3.connect('timers.db')
-    c = conn.cursor()
-    c.execute(query, args)
-    conn.commit()
-    conn.close()
+    get_local_store().execute(query, args)
 
 def initialize_database():
     """
-    Initializes the timers.db database and creates the timers table if it doesn't exist.
+    Opens the local timers database and creates the timers table if it doesn't exist.
     """
-    if not os.path.exists('timers.db'):
-        logger.info('Database timers.db does not exist. Creating a new one.')
-    else:
-        logger.info('Database timers.db already exists.')
-
-    # Create the timers table if it doesn't exist
-    execute_db_query('''
-    CREATE TABLE IF NOT EXISTS timers (
-        discord_user_id TEXT PRIMARY KEY,
-        role_id TEXT,
-        expiration_time TEXT,
-        start_time TEXT
-    )
-    ''')
-    logger.info('Timers table ensured to exist in timers.db.')
+    get_local_store().initialize()
+    logger.info(f'Timers table ensured to exist in {config.TIMERS_DB_PATH}.')
     
 def is_valid_container_name(name):
     # Allow alphanumeric characters, underscores, and hyphens
@@ -59,13 +45,16 @@ def run_command(command):
     except subprocess.CalledProcessError as e:
         logger.error(f"Command failed with error: {e.stderr}")
         raise
+
 def run_rsync():
     """
     Stops the MongoDB clone container, runs the rsync command to synchronize the MongoDB data from the original to the clone, and then restarts the container.
+    Returns the duration in seconds of the stop, sync and start steps.
     """
     container_name = config.MONGODB_CLONE_CONTAINER_NAME
     main_data_path = config.MONGODB_MAIN_DATA_PATH
     clone_data_path = config.MONGODB_CLONE_DATA_PATH
+    timings = {}
 
     # Validate container name
     if not is_valid_container_name(container_name):
@@ -80,20 +69,84 @@ def run_rsync():
 
     # Stop MongoDB Docker container
     logger.info("Stopping MongoDB clone container...")
+    started = time.monotonic()
     run_command(['docker', 'stop', container_name])
+    timings['stop'] = time.monotonic() - started
 
-    # Run rsync
+    # Run rsync. Both paths are local, so copy whole files and skip compression.
     try:
         logger.info("Running rsync to synchronize MongoDB data...")
+        started = time.monotonic()
         result = run_command(
             [
-                'rsync', '-avz', '--delete',
+                'rsync', '-a', '--whole-file', '--delete',
                 f"{main_data_path}/",
                 f"{clone_data_path}/"
             ]
         )
+        timings['sync'] = time.monotonic() - started
         logger.debug(f"rsync output:\n{result}")
     finally:
         # Start MongoDB Docker container
         logger.info("Starting MongoDB clone container...")
-        run_command(['docker', 'start', container_name])
\ No newline at end of file
+        started = time.monotonic()
+        run_command(['docker', 'start', container_name])
+        timings['start'] = time.monotonic() - started
+
+    return timings
+
+def wait_for_mongodb(timeout):
+    """
+    Pings MongoDB until it answers or the timeout runs out.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        client = MongoClient(config.MONGODB_URI, serverSelectionTimeoutMS=1000)
+        try:
+            client.admin.command('ping')
+            return
+        except mongo_errors.PyMongoError:
+            if time.monotonic() >= deadline:
+                raise
+        finally:
+            client.close()
+
+class CloneRefresher:
+    """
+    Decides when the MongoDB clone needs a refresh. A clone younger than max_staleness
+    seconds is used as is.
+    """
+    def __init__(self, max_staleness):
+        self.max_staleness = max_staleness
+        self.refreshed_at = None
+
+    def age(self):
+        """
+        Returns how many seconds ago the clone's data was copied, 0 before the first refresh.
+        """
+        return 0.0 if self.refreshed_at is None else time.monotonic() - self.refreshed_at
+
+    def refresh(self):
+        """
+        Refreshes the clone if it is stale. Returns True when the clone was restarted.
+        """
+        now = time.monotonic()
+        if self.refreshed_at is not None and now - self.refreshed_at < self.max_staleness:
+            logger.debug(f"MongoDB clone is {now - self.refreshed_at:.0f}s old, skipping refresh.")
+            return False
+
+        timings = run_rsync()
+        started = time.monotonic()
+        wait_for_mongodb(config.CLONE_READY_TIMEOUT)
+        timings['first_ping'] = time.monotonic() - started
+
+        self.refreshed_at = now
+        for step, seconds in timings.items():
+            metrics.observe(f'clone_{step}', seconds)
+        logger.info(
+            f"MongoDB clone refreshed: stop {timings['stop']:.2f}s, sync {timings['sync']:.2f}s, "
+            f"start {timings['start']:.2f}s, first ping {timings['first_ping']:.2f}s"
+        )
+        return True
+
+clone_refresher = CloneRefresher(config.CLONE_MAX_STALENESS)